@@ -0,0 +1,362 @@
+'''
+Offline benchmarks for the realtime processing nodes. Each one drives the
+nodes as fast as possible (outside of a graph, with no LSL or display) and
+saves its results as json to `RESULTS_DIR`, tagged with the git commit, so
+runs can be compared across commits.
+
+    python benchmark.py qrs --heart-rate 80 --noise .05
+    python benchmark.py qrs --log logs/sub-01_20220101-120000.h5
+    python benchmark.py control
+'''
+import neurokit2 as nk
+import numpy as np
+import subprocess
+import argparse
+import asyncio
+import json
+import time
+import os
+import h5py
+from scipy.stats import norm
+from time import strftime
+
+from util._messages import SampleMessage, FloatMessage, DisplayMessage
+from util.bandpass import BandPass, BandPassConfig
+from util.qrs import QRSDetector, QRSDetectorConfig
+from util.control import Control, ControlConfig, size_profile
+from util.ecg import simulate_ecg
+from util.logs import column, iter_records
+import labgraph as lg
+
+RESULTS_DIR = 'benchmarks'
+# filter settings used by graph.py
+LOW_CUTOFF = 5.
+HIGH_CUTOFF = 15.
+
+def git_commit():
+    '''
+    Current commit hash, marked "-dirty" if there are uncommitted changes,
+    or None outside of a git checkout.
+    '''
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr = subprocess.DEVNULL
+            ).decode().strip()
+        dirty = subprocess.call(
+            ['git', 'diff', '--quiet', 'HEAD'],
+            stderr = subprocess.DEVNULL
+            )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+def percentiles(x, scale = 1.):
+    '''
+    Summarizes a distribution as a dict of percentiles (and max), multiplied
+    by `scale` (e.g. to convert seconds to ms).
+    '''
+    x = np.asarray(x, dtype = float) * scale
+    if x.size == 0:
+        return dict(p50 = None, p95 = None, p99 = None, max = None)
+    p50, p95, p99 = np.percentile(x, [50, 95, 99])
+    return dict(p50 = p50, p95 = p95, p99 = p99, max = x.max())
+
+def reference_peaks(ecg, sfreq):
+    '''
+    Offline R-peak locations (sample indices) to score the online detector
+    against, found by neurokit2 with the whole recording available.
+    '''
+    sfreq = int(sfreq)
+    cleaned = nk.ecg_clean(ecg, sampling_rate = sfreq)
+    _, info = nk.ecg_peaks(cleaned, sampling_rate = sfreq)
+    return np.asarray(info['ECG_R_Peaks'], dtype = int)
+
+def simulated_recording(args):
+    '''
+    Simulates an ECG recording with known R-peaks. The peaks are located on
+    the noise-free simulation, and noise is added afterwards, so the noise
+    level doesn't affect the reference.
+
+    Returns
+    -------
+    ecg : np.ndarray, (n_samples, 1)
+    ts : np.ndarray, (n_samples,)
+    ref : np.ndarray
+        Sample indices of the true R-peaks.
+    '''
+    clean = simulate_ecg(
+        duration = args.duration,
+        sfreq = args.sfreq,
+        heart_rate = args.heart_rate,
+        heart_rate_std = args.heart_rate_std,
+        noise = 0.,
+        seed = args.seed,
+        cache_dir = args.cache_dir
+        )
+    clean = np.asarray(clean, dtype = float)
+    ref = reference_peaks(clean, args.sfreq)
+    ecg = clean
+    if args.noise > 0:
+        ecg = nk.signal_distort(
+            clean,
+            sampling_rate = int(args.sfreq),
+            noise_amplitude = args.noise,
+            random_state = args.seed
+            )
+    ts = np.arange(ecg.size) / args.sfreq
+    return np.asarray(ecg, dtype = float)[:, None], ts, ref
+
+def logged_recording(args):
+    '''
+    Reads `ecg_raw` from a log written by graph.py, and finds reference
+    R-peaks in the logged channel offline.
+    '''
+    with h5py.File(args.log, 'r') as f:
+        blocks = list(iter_records(f['ecg_raw']))
+    records = np.concatenate(blocks)
+    ts = column(records, 'timestamp').astype(float)
+    ecg = column(records, 'data').astype(float)
+    ecg = ecg.reshape(ecg.shape[0], -1)
+    ref = reference_peaks(ecg[:, args.channel], args.sfreq)
+    return ecg, ts, ref
+
+def match_peaks(ref, det, max_latency):
+    '''
+    Pairs each reference R-peak with the first unmatched detection that
+    follows it by at most `max_latency` samples.
+
+    Returns
+    -------
+    latency : np.ndarray
+        Detection latency of each matched peak, in samples.
+    '''
+    latency = []
+    j = 0
+    for r in ref:
+        while j < det.size and det[j] < r:
+            j += 1
+        if j < det.size and det[j] - r <= max_latency:
+            latency.append(det[j] - r)
+            j += 1
+    return np.array(latency, dtype = float)
+
+async def drive(nodes, messages):
+    '''
+    Passes each message through a chain of subscriber methods in turn,
+    as the graph would, and returns the outputs of the last one.
+    '''
+    outputs = []
+    async def push(i, message):
+        if i == len(nodes):
+            outputs.append(message)
+            return
+        # skip side outputs, e.g. lead switches
+        method, message_type = nodes[i]
+        async for _, out in method(message):
+            if isinstance(out, message_type):
+                await push(i + 1, out)
+    for message in messages:
+        await push(0, message)
+    return outputs
+
+def bench_qrs(args):
+    '''
+    Runs a recording through QRSDetector (behind a BandPass, as in the
+    experiment, unless --no-bandpass) and scores the detections against
+    reference R-peaks.
+    '''
+    if args.log:
+        ecg, ts, ref = logged_recording(args)
+    else:
+        ecg, ts, ref = simulated_recording(args)
+    sfreq = args.sfreq
+
+    with lg.NodeTestHarness(BandPass).get_node(
+            config = BandPassConfig(
+                low_cutoff = LOW_CUTOFF,
+                high_cutoff = HIGH_CUTOFF,
+                sfreq = sfreq,
+                ch_idx = args.channel,
+                convert_microV_to_mV = args.convert
+            )) as bandpass, \
+         lg.NodeTestHarness(QRSDetector).get_node(
+            config = QRSDetectorConfig(sfreq = sfreq)
+            ) as detector:
+        if args.no_bandpass:
+            messages = [
+                FloatMessage(timestamp = t, data = float(x))
+                for t, x in zip(ts, ecg[:, args.channel])
+                ]
+            nodes = [(detector.process, FloatMessage)]
+        else:
+            messages = [
+                SampleMessage(timestamp = t, data = x)
+                for t, x in zip(ts, ecg)
+                ]
+            nodes = [
+                (bandpass.filter, FloatMessage),
+                (detector.process, FloatMessage)
+                ]
+        t0 = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        outputs = loop.run_until_complete(drive(nodes, messages))
+        elapsed = time.perf_counter() - t0
+
+    t_since = np.array([out.data for out in outputs])
+    det = np.flatnonzero(t_since == 0.)
+    # ignore the detector's warm-up while its buffer fills
+    start = int(args.warmup * sfreq)
+    ref = ref[ref >= start]
+    det = det[det >= start]
+    latency = match_peaks(ref, det, int(args.max_latency * sfreq))
+    n_matched = latency.size
+
+    return dict(
+        n_samples = len(messages),
+        n_reference = int(ref.size),
+        n_detected = int(det.size),
+        n_matched = int(n_matched),
+        sensitivity = n_matched / ref.size if ref.size else None,
+        ppv = n_matched / det.size if det.size else None,
+        latency_ms = percentiles(latency, 1e3 / sfreq),
+        elapsed = elapsed,
+        samples_per_sec = len(messages) / elapsed,
+        us_per_sample = 1e6 * elapsed / len(messages)
+    )
+
+def add_qrs_args(parser):
+    parser.add_argument('--log', type = str, default = None,
+        help = 'score ecg_raw from this log instead of simulated ECG')
+    parser.add_argument('--channel', type = int, default = 0)
+    parser.add_argument('--convert', action = 'store_true',
+        help = 'convert input from microV to mV, as for logged ECG')
+    parser.add_argument('--no-bandpass', action = 'store_true',
+        help = 'feed the detector the raw ECG directly')
+    parser.add_argument('--sfreq', type = float, default = 100.)
+    parser.add_argument('--duration', type = float, default = 300.)
+    parser.add_argument('--heart-rate', type = float, default = 70.)
+    parser.add_argument('--heart-rate-std', type = float, default = 5.)
+    parser.add_argument('--noise', type = float, default = .05)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--cache-dir', type = str, default = '.cache')
+    parser.add_argument('--warmup', type = float, default = 1.,
+        help = 'seconds at the start of the recording not to score')
+    parser.add_argument('--max-latency', type = float, default = .25,
+        help = 'latest a detection can come after its R-peak, in seconds')
+
+def time_per_call(f, n):
+    '''
+    Mean wall time of f() over n calls, in microseconds.
+    '''
+    t0 = time.perf_counter()
+    for _ in range(n):
+        f()
+    return 1e6 * (time.perf_counter() - t0) / n
+
+def bench_control(args):
+    '''
+    Times Control's mapping from time since R-peak to stimulus sizes, per
+    message through the node and per call of the size function, and checks
+    the size function against the scipy.stats.norm expression it replaced.
+    '''
+    rng = np.random.RandomState(args.seed)
+    # time since R-peak for a run of beats at the given heart rate
+    n = int(args.duration * args.sfreq)
+    ibis = rng.normal(60. / args.heart_rate, args.heart_rate_std / 60., n)
+    ibis = np.maximum(ibis, .3)
+    t_since = []
+    for ibi in ibis:
+        t_since.extend(np.arange(0., ibi, 1. / args.sfreq))
+        if len(t_since) >= n:
+            break
+    t_since = np.array(t_since[:n])
+    ts = np.arange(n) / args.sfreq
+
+    config = ControlConfig()
+    phase, scale = config.systole_lag, config.scale
+    ref = norm.pdf(t_since, loc = phase, scale = scale) \
+            / norm.pdf(phase, loc = phase, scale = scale)
+
+    with lg.NodeTestHarness(Control).get_node(config = config) as control:
+        messages = [
+            FloatMessage(timestamp = t, data = x)
+            for t, x in zip(ts, t_since)
+            ]
+        t0 = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        outputs = loop.run_until_complete(
+            drive([(control.map_to_size, DisplayMessage)], messages)
+            )
+        elapsed = time.perf_counter() - t0
+        sizes = np.array([control.size_func(x, phase) for x in t_since])
+        x = float(t_since[n // 2])
+        us_size_func = time_per_call(lambda: control.size_func(x, phase), n)
+
+    us_scipy = time_per_call(
+        lambda: norm.pdf(x, loc = phase, scale = scale)
+                / norm.pdf(phase, loc = phase, scale = scale),
+        min(n, 2000) # this one's slow
+        )
+    t0 = time.perf_counter()
+    block = size_profile(t_since, phase, scale)
+    us_block = 1e6 * (time.perf_counter() - t0)
+
+    return dict(
+        n_messages = len(messages),
+        us_per_message = 1e6 * elapsed / len(outputs),
+        messages_per_sec = len(outputs) / elapsed,
+        us_per_size_func = us_size_func,
+        us_per_size_scipy = us_scipy,
+        us_per_sample_vectorized = us_block / n,
+        max_abs_err = float(np.abs(sizes - ref).max()),
+        max_abs_err_vectorized = float(np.abs(block - ref).max())
+    )
+
+def add_control_args(parser):
+    parser.add_argument('--sfreq', type = float, default = 100.)
+    parser.add_argument('--duration', type = float, default = 300.)
+    parser.add_argument('--heart-rate', type = float, default = 70.)
+    parser.add_argument('--heart-rate-std', type = float, default = 5.)
+    parser.add_argument('--seed', type = int, default = 0)
+
+BENCHMARKS = {
+    'qrs': (bench_qrs, add_qrs_args),
+    'control': (bench_control, add_control_args),
+}
+
+def main(args):
+    bench, _ = BENCHMARKS[args.benchmark]
+    params = {k: v for k, v in vars(args).items() if k != 'out'}
+    results = bench(args)
+    commit = git_commit()
+    report = dict(
+        benchmark = args.benchmark,
+        commit = commit,
+        date = strftime('%Y-%m-%dT%H:%M:%S'),
+        params = params,
+        results = results
+    )
+    print(json.dumps(results, indent = 4))
+    fpath = args.out
+    if fpath is None:
+        fname = '%s_%s_%s.json'%(
+            args.benchmark, commit or 'nogit', strftime('%Y%m%d-%H%M%S')
+            )
+        fpath = os.path.join(RESULTS_DIR, fname)
+    os.makedirs(os.path.dirname(fpath) or '.', exist_ok = True)
+    with open(fpath, 'w') as f:
+        json.dump(report, f, indent = 4)
+    print('saved results to %s'%fpath)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', type = str, default = None,
+        help = 'json file to save results to (default: %s/)'%RESULTS_DIR)
+    subparsers = parser.add_subparsers(dest = 'benchmark')
+    subparsers.required = True
+    for name, (_, add_args) in BENCHMARKS.items():
+        add_args(subparsers.add_parser(name))
+    args = parser.parse_args()
+    main(args)
@@ -2,7 +2,7 @@ import numpy as np
 import pandas as pd
 import h5py
 import json
-import re
+import gzip
 import os
 from mne_bids import BIDSPath
 from mne_bids.write import (
@@ -12,74 +12,150 @@ from mne_bids.write import (
 )
 import argparse
 
+from util.calibration import load_calibration
+from util.logs import column, decode, read_topic, iter_records
+
 SOURCE_DIR = 'logs'
 BIDS_ROOT = 'bids_dataset'
-DELAY_SAMPLES = 3
+SFREQ = 100. # sampling rate of the logged ECG (graph.SFREQ)
+READ_SIZE = 100000 # records of each topic to hold in memory at once
+CHAN_NAMES = ['ecg', 'synchronous', 'asynchronous']
 
-_stringify = lambda s: re.findall("'(\w+)'", str(s))[0] # rms weird encoding
-stringify = lambda s: s if isinstance(s, str) else _stringify(s)
+def delay_samples(f) -> int:
+    '''
+    Samples by which the logged ECG lags its timestamps: the amplifier's
+    delay plus, if it was recorded through the decimator, the decimator's.
+    graph.py saves both as attributes of the log; for logs without them, the
+    amplifier's delay comes from the calibration file (see calibrate.py)
+    and the decimator's is taken to be zero.
+    '''
+    delay = f.attrs.get('hardware_delay', load_calibration()['hardware_delay'])
+    delay += f.attrs.get('decimation_delay', 0.)
+    return int(round(delay * SFREQ))
 
-def read_physio(f, delay_samples = 0):
+def _iter_stims(f, delay_samples = 0, read_size = READ_SIZE):
     '''
+    Yields the logged stimulus sizes a chunk at a time as (time, sizes),
+    with the sizes shifted `delay_samples` rows later (and NaN before that).
+    '''
+    carry = np.full((delay_samples, 2), np.nan)
+    for stim_size in iter_records(f['stim_size'], read_size):
+        t = column(stim_size, 'timestamp').astype(float)
+        sizes = np.column_stack((
+            column(stim_size, 'sz_sync').astype(float),
+            column(stim_size, 'sz_async').astype(float)
+        ))
+        sizes = np.concatenate((carry, sizes))
+        carry = sizes[sizes.shape[0] - delay_samples:]
+        yield t, sizes[:t.size]
+
+def iter_physio(f, mapping = None, delay_samples = 0, read_size = READ_SIZE):
+    '''
+    Yields the ECG merged with the stimulus sizes on timestamp, as DataFrames
+    of `read_size` or so rows, so only a chunk of each topic is ever held in
+    memory.
+
     Arguments
     ---------
     f : h5py.File
         The h5 database object containing experiment logs.
+    mapping : tuple
+        Intercept and slope of time against row number (see
+        `dejitter_mapping`) to replace the timestamps with, if given.
     delay_samples : int
-        The hardware delay in samples. This is something you have
+        The delay of the ECG behind its timestamps in samples (see
+        `delay_samples`). The hardware delay is something you have
         to measure on your own hardware. (e.g. Our TMSi SAGA amplifier has
         a delay of ~34 ms, and our sampling rate was 100, so for us this
-        will be delay_samples = 3.)
-    '''
-    ecg_raw = f['ecg_raw'][:]
-    t_ecg = np.vectorize(lambda x: x[0])(ecg_raw).astype(float)
-    ecg = np.vectorize(lambda x: x[1][0])(ecg_raw).astype(float)
-    ecg /= 1e3 # convert units from microV to mV
-    ecg = pd.DataFrame({'time': t_ecg, 'ecg': ecg})
-
-    stim_size = f['stim_size'][:]
-    t_stim = np.vectorize(lambda x: x[0])(stim_size).astype(float)
-    sync_stim = np.vectorize(lambda x: x[1])(stim_size).astype(float)
-    async_stim = np.vectorize(lambda x: x[2])(stim_size).astype(float)
-    stims = pd.DataFrame({
-        'time': t_stim,
-        'synchronous': sync_stim,
-        'asynchronous': async_stim
-    })
-    # compensate for hardware delay
-    stims['synchronous'] = np.roll(stims.synchronous, delay_samples)
-    stims['asynchronous'] = np.roll(stims.asynchronous, delay_samples)
-
-    # merge on timestamp
-    physio = pd.merge(ecg, stims, on = 'time')
-
-    # de-jitter timestamps
-    idx = np.arange(0, physio.time.size, 1)[:, None]
-    X = np.concatenate((np.ones_like(idx), idx), axis = 1)
-    y = physio.time
-    mapping = np.linalg.lstsq(X, y, rcond = -1)[0]
-    time_stamps = mapping[0] + mapping[1] * idx
-    time_stamps = time_stamps[:, 0]
-    physio.time = time_stamps
+        will be 3 samples, plus 2 for the decimator's 20 ms.)
+    read_size : int
+        How many records of each topic to read from disk at once.
+    '''
+    stims = _iter_stims(f, delay_samples, read_size)
+    t_stim = np.zeros(0)
+    sizes = np.zeros((0, 2))
+    n = 0 # rows yielded so far
+    for ecg_raw in iter_records(f['ecg_raw'], read_size):
+        t_ecg = column(ecg_raw, 'timestamp').astype(float)
+        t_end = t_ecg.max()
+        # read stimulus sizes until they've caught up with this chunk
+        while not t_stim.size or t_stim[-1] < t_end:
+            chunk = next(stims, None)
+            if chunk is None:
+                break
+            t_stim = np.concatenate((t_stim, chunk[0]))
+            sizes = np.concatenate((sizes, chunk[1]))
+        _, i, j = np.intersect1d(t_ecg, t_stim, return_indices = True)
+        order = np.argsort(i) # keep the ECG's order, not the timestamps'
+        i, j = i[order], j[order]
+        if mapping is None:
+            t = t_ecg[i]
+        else: # de-jittered
+            t = mapping[0] + mapping[1] * np.arange(n, n + i.size)
+        n += i.size
+        yield pd.DataFrame({
+            'time': t,
+            # convert units from microV to mV
+            'ecg': column(ecg_raw, 'data')[i, 0].astype(float) / 1e3,
+            'synchronous': sizes[j, 0],
+            'asynchronous': sizes[j, 1]
+        })
+        later = t_stim > t_end # any left over go with the next chunk
+        t_stim, sizes = t_stim[later], sizes[later]
 
-    return physio
+def dejitter_mapping(f, read_size = READ_SIZE):
+    '''
+    Intercept and slope of the least squares line through the merged
+    timestamps against their row numbers, so the timestamps can be replaced
+    with evenly spaced ones. Accumulated a chunk at a time.
+    '''
+    sums = np.zeros(5) # n, x, x^2, y, xy
+    n = 0
+    t0 = None # subtracted from times for precision
+    for physio in iter_physio(f, read_size = read_size):
+        t = physio.time.to_numpy()
+        if not t.size:
+            continue
+        if t0 is None:
+            t0 = t[0]
+        x = np.arange(n, n + t.size, dtype = float)
+        y = t - t0
+        sums += (t.size, x.sum(), (x * x).sum(), y.sum(), (x * y).sum())
+        n += t.size
+    n, sx, sxx, sy, sxy = sums
+    slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    intercept = t0 + (sy - slope * sx) / n
+    return intercept, slope
 
-def read_rivalry_events(f, run = 0):
+def read_events(f):
     '''
+    All experiment events, as a DataFrame with columns onset, sync_side and
+    key, to be split up by `read_rivalry_events` and
+    `read_discrimination_events`.
+
     Arguments
     ---------
     f : h5py.File
         The h5 database object containing experiment logs.
+    '''
+    evs = read_topic(f, 'experiment_events')
+    return pd.DataFrame({
+        'onset': column(evs, 'timestamp').astype(float),
+        'sync_side': decode(column(evs, 'sync_side')),
+        'key': decode(column(evs, 'key'))
+    })
+
+def read_rivalry_events(events, run = 0):
+    '''
+    Arguments
+    ---------
+    events : pd.DataFrame
+        All experiment events, from `read_events`.
     run : int
         Which rivalry block/run to read.
     '''
-    evs = f['experiment_events'][:]
-    t_event = np.vectorize(lambda x: x[0])(evs).astype(float)
-    events = np.vectorize(lambda x: x[1])(evs)
-    events = [stringify(ev) for ev in events]
-    sync_side = np.vectorize(lambda x: x[-1])(evs)
-    sync_side = np.array([stringify(ss) for ss in sync_side])
-    events = pd.DataFrame({'onset': t_event, 'sync_side': sync_side, 'key': events})
+    events = events.copy()
+    sync_side = events.sync_side.to_numpy()
 
     events['sync_dominant'] = events.key == sync_side
     events['dominant'] = events.sync_dominant.replace({
@@ -119,14 +195,7 @@ def read_rivalry_events(f, run = 0):
 
     return events
 
-def read_discrimination_events(f):
-    evs = f['experiment_events'][:]
-    t_event = np.vectorize(lambda x: x[0])(evs).astype(float)
-    events = np.vectorize(lambda x: x[1])(evs)
-    events = [stringify(ev) for ev in events]
-    sync_side = np.vectorize(lambda x: x[-1])(evs)
-    sync_side = np.array([stringify(ss) for ss in sync_side])
-    events = pd.DataFrame({'onset': t_event, 'sync_side': sync_side, 'key': events})
+def read_discrimination_events(events):
     start_idx = events.index[events.key == 'start_trial1'][0] # first trial
     events = events.iloc[start_idx:]
     events = events.reset_index()
@@ -147,67 +216,112 @@ def read_discrimination_events(f):
     return events
 
 
-def crop(events, physio):
+def crop(events):
     '''
-    crops physio to a task block
+    Times a task block's events from its start, and returns them with the
+    start and end time of the block, to crop physio to.
     '''
+    events = events.copy()
     t_start = events.onset.iloc[0]
     if np.isfinite(events.duration.iloc[-1]):
         t_stop = events.onset.iloc[-1] + events.duration.iloc[-1]
     else:
         t_stop = events.onset.iloc[-1]
-    physio = physio[(physio.time >= t_start) & (physio.time <= t_stop)]
     events.onset -= t_start
-    physio.time -= t_start
-    return events, physio
-
-def save(events, physio, sub, task, run, srate = 100):
-    ## save physio data
-    chan_names = ['ecg', 'synchronous', 'asynchronous']
-    bids_path = BIDSPath(
-        root = BIDS_ROOT,
-        subject = sub,
-        datatype = 'beh',
-        task = task,
-        run = run,
-        suffix = 'physio',
-        extension = '.tsv.gz'
-    )
-    # prepare sidecar file
-    info = {
-        'Manufacturer': 'TMSi SAGA',
-        'PowerLineFrequency': 60.,
-        'SamplingFrequency': srate,
-        'RecordingDuration': physio.time.iloc[-1],
-        'StartTime': physio.time.iloc[0],
-        'Columns': chan_names
-    }
-    for chan in chan_names:
-        chan_info = {}
-        chan_info['Units'] = 'mV' if chan == 'ecg' else 'n/a'
-        chan_info['low_cutoff'] = 'n/a'
-        chan_info['high_cutoff'] = 'n/a'
-        info[chan] = chan_info
-    # create directory structure
-    bids_path.mkdir()
-    f = str(bids_path.fpath)
-    # write data
-    physio = physio[chan_names]
-    physio.to_csv(f, sep = '\t', index = False, header = False, na_rep = 'n/a')
-    # write sidecar file
-    json_fpath = f.replace('tsv.gz', 'json')
-    json_f = open(json_fpath, "w")
-    json.dump(info, json_f, indent = 4)
-    json_f.close()
-
-    ## write events file
-    events_f = f.replace('_physio.tsv.gz', '_events.tsv')
-    events.to_csv(events_f, sep = '\t', index = False, na_rep = 'n/a')
+    return events, t_start, t_stop
+
+def save(f, blocks, sub, mapping, delay_samples = 0, srate = 100):
+    '''
+    Writes each task block's physio, events and sidecar files. The physio is
+    streamed from the log in chunks and each chunk's rows are appended to the
+    block(s) they belong to, so every block is written in a single pass over
+    the log, however long the recording.
+
+    Arguments
+    ---------
+    f : h5py.File
+        The h5 database object containing experiment logs.
+    blocks : list
+        (task, run, events) for each block.
+    sub : str
+        Subject label.
+    mapping : tuple
+        De-jittered timestamps, from `dejitter_mapping`.
+    delay_samples : int
+        See `iter_physio`.
+    '''
+    writers = []
+    try:
+        for task, run, events in blocks:
+            events, t_start, t_stop = crop(events)
+            bids_path = BIDSPath(
+                root = BIDS_ROOT,
+                subject = sub,
+                datatype = 'beh',
+                task = task,
+                run = run,
+                suffix = 'physio',
+                extension = '.tsv.gz'
+            )
+            # create directory structure
+            bids_path.mkdir()
+            fpath = str(bids_path.fpath)
+            ## write events file
+            events_f = fpath.replace('_physio.tsv.gz', '_events.tsv')
+            events.to_csv(events_f, sep = '\t', index = False, na_rep = 'n/a')
+            writers.append(dict(
+                fpath = fpath,
+                file = gzip.open(fpath, 'wt'),
+                t_start = t_start,
+                t_stop = t_stop,
+                first = None, # time of first and last rows written
+                last = None
+            ))
+
+        ## write physio data
+        for physio in iter_physio(f, mapping, delay_samples):
+            t = physio.time.to_numpy()
+            for w in writers:
+                in_block = (t >= w['t_start']) & (t <= w['t_stop'])
+                if not in_block.any():
+                    continue
+                physio[in_block][CHAN_NAMES].to_csv(
+                    w['file'], sep = '\t', index = False, header = False,
+                    na_rep = 'n/a'
+                    )
+                if w['first'] is None:
+                    w['first'] = t[in_block][0] - w['t_start']
+                w['last'] = t[in_block][-1] - w['t_start']
+    finally:
+        for w in writers:
+            w['file'].close()
+
+    for w in writers:
+        # prepare sidecar file
+        info = {
+            'Manufacturer': 'TMSi SAGA',
+            'PowerLineFrequency': 60.,
+            'SamplingFrequency': srate,
+            'RecordingDuration': w['last'],
+            'StartTime': w['first'],
+            'Columns': CHAN_NAMES
+        }
+        for chan in CHAN_NAMES:
+            chan_info = {}
+            chan_info['Units'] = 'mV' if chan == 'ecg' else 'n/a'
+            chan_info['low_cutoff'] = 'n/a'
+            chan_info['high_cutoff'] = 'n/a'
+            info[chan] = chan_info
+        # write sidecar file
+        json_fpath = w['fpath'].replace('tsv.gz', 'json')
+        json_f = open(json_fpath, "w")
+        json.dump(info, json_f, indent = 4)
+        json_f.close()
 
     ## write dataset description files if needed
     # write dataset description files
-    readme_fname = os.path.join(bids_path.root, 'README')
-    participants_tsv_fname = os.path.join(bids_path.root, 'participants.tsv')
+    readme_fname = os.path.join(BIDS_ROOT, 'README')
+    participants_tsv_fname = os.path.join(BIDS_ROOT, 'participants.tsv')
     participants_json_fname = participants_tsv_fname.replace('.tsv', '.json')
     # make a class to trick MNE-BIDS's highly unecessary call to MNE raw object
     class Dumb:
@@ -217,9 +331,9 @@ def save(events, physio, sub, task, run, srate = 100):
         def __init__(self):
             self.info = Dumb()
     dummy_raw = Dumber()
-    _participants_tsv(dummy_raw, bids_path.subject, participants_tsv_fname)
+    _participants_tsv(dummy_raw, sub, participants_tsv_fname)
     _participants_json(participants_json_fname, True)
-    make_dataset_description(path = bids_path.root, name = 'ecg-rivalry')
+    make_dataset_description(path = BIDS_ROOT, name = 'ecg-rivalry')
 
 def main(sub):
     # find subject's log file
@@ -230,16 +344,19 @@ def main(sub):
     fpath = os.path.join(SOURCE_DIR, fname)
     f = h5py.File(fpath, 'r')
 
-    physio = read_physio(f, DELAY_SAMPLES)
-
-    for block in range(2):
-        events = read_rivalry_events(f, block)
-        events, physio_cropped = crop(events, physio)
-        save(events, physio_cropped, sub, 'rivalry', block + 1)
+    all_events = read_events(f)
+    blocks = [
+        ('rivalry', block + 1, read_rivalry_events(all_events, block))
+        for block in range(2)
+    ]
+    blocks.append(
+        ('discrimination', 1, read_discrimination_events(all_events))
+    )
 
-    events = read_discrimination_events(f)
-    events, physio_cropped = crop(events, physio)
-    save(events, physio_cropped, sub, 'discrimination', 1)
+    # two passes over the log: one to fit the de-jittered timestamps, and
+    # one to write out every block
+    mapping = dejitter_mapping(f)
+    save(f, blocks, sub, mapping, delay_samples(f))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,241 @@
+'''
+Measures the delays the experiment compensates for, by running the real
+Experiment graph (as set up in graph.py) on synthetic ECG with known R-peak
+times, and saves them to the calibration file that graph.py and bidsify.py
+read (see util/calibration.py).
+
+The synthetic ECG is pushed through a local LSL outlet in real time, so it
+goes through the same poller, decimator, filter, detector, controller and
+display as a live recording would. The display runs just its two rivalry
+blocks, `--duration` seconds in all, so you'll need to press through its
+instructions (no participant needed).
+
+    python calibrate.py --duration 120
+
+This measures everything after the amplifier; the amplifier's own delay is
+carried over from the existing calibration file unless `--hardware-delay` is
+given.
+'''
+import numpy as np
+import threading
+import argparse
+import json
+import socket
+import os
+import h5py
+from time import strftime
+from pylsl import StreamInfo, StreamOutlet, local_clock
+
+from benchmark import reference_peaks, percentiles, git_commit
+from util.ecg import simulate_ecg
+from util.logs import column, read_topic
+from util.calibration import CALIBRATION_FILE, load_calibration, save_calibration
+from util._trace import CONTROL, DISPLAY
+import labgraph as lg
+
+LOG_DIR = './logs'
+
+class SyntheticOutlet(object):
+    """
+    Streams a recording over LSL as if it were being acquired now, looping it
+    for as long as it runs. Sample i is pushed at, and timestamped with, the
+    local clock time `t0 + i / sfreq`, so its timestamp is its true time.
+
+    It's given a source_id of its own, for the graph to resolve it by, since
+    an amplifier stream of the same type may well be up too.
+    """
+    def __init__(self, ecg: np.ndarray, sfreq: float, source_id: str,
+                 n_channels: int = 1, stream_type: str = 'EEG'):
+        """
+        Constructor.
+        @param ecg: the recording, one channel, in microvolts
+        @type  ecg: np.ndarray
+        @param sfreq: its sampling rate
+        @type  sfreq: float
+        @param source_id: LSL source_id, unique to this run
+        @type  source_id: str
+        @param n_channels: channels to stream, each a copy of `ecg`
+        @type  n_channels: int
+        @param stream_type: LSL stream type
+        @type  stream_type: str
+        """
+        self.ecg = np.repeat(np.asarray(ecg, dtype = float)[:, None],
+                             n_channels, axis = 1)
+        self.sfreq = sfreq
+        info = StreamInfo(
+            'calibration', stream_type, n_channels, sfreq, 'float32', source_id
+            )
+        self._outlet = StreamOutlet(info)
+        self._stop = threading.Event()
+        self._thread = None
+        self.t0 = None
+        self.n_pushed = 0
+
+    def _run(self) -> None:
+        n = self.ecg.shape[0]
+        while not self._stop.is_set():
+            n_due = int((local_clock() - self.t0) * self.sfreq) + 1
+            for i in range(self.n_pushed, n_due):
+                self._outlet.push_sample(self.ecg[i % n], self.t0 + i / self.sfreq)
+            self.n_pushed = max(self.n_pushed, n_due)
+            self._stop.wait(.01)
+
+    def start(self) -> None:
+        self.t0 = local_clock()
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def peak_times(self, peaks: np.ndarray) -> np.ndarray:
+        '''
+        True times of the R-peaks at sample indices `peaks` of the recording,
+        over every loop of it that has been pushed so far.
+        '''
+        n = self.ecg.shape[0]
+        loops = np.arange(self.n_pushed // n + 1)
+        idx = (peaks[None, :] + n * loops[:, None]).ravel()
+        idx = idx[idx < self.n_pushed]
+        return self.t0 + idx / self.sfreq
+
+def measure(fpath: str, peak_t: np.ndarray, max_latency: float) -> dict:
+    '''
+    Matches the detections logged in `fpath` to the true R-peak times, and
+    measures the delays from each R-peak to its detection, to the detection
+    reaching Control, and to the first frame showing the resulting stimulus.
+
+    Returns
+    -------
+    results : dict
+        Percentiles in ms, and `signal_lag`, the median delay from an R-peak
+        to the sample it was detected at, in seconds.
+    '''
+    with h5py.File(fpath, 'r') as f:
+        t_since = read_topic(f, 't_since')
+        stim = read_topic(f, 'stim_size')
+        traces = read_topic(f, 'latency_trace')
+    ts = column(t_since, 'timestamp').astype(float)
+    det_t = ts[column(t_since, 'data') == 0.] # detector resets on detection
+
+    # pair each detection with the last R-peak before it, keeping only the
+    # first detection of each peak
+    idx = np.searchsorted(peak_t, det_t, side = 'right') - 1
+    lag = det_t - peak_t[np.maximum(idx, 0)]
+    ok = (idx >= 0) & (lag <= max_latency)
+    _, first = np.unique(idx[ok], return_index = True)
+    det_t, lag = det_t[ok][first], lag[ok][first]
+
+    # when each detection got to Control, and when the stimulus it set was
+    # first flipped onto the screen (if it wasn't superseded first)
+    stim_trace = column(stim, 'trace')
+    to_control = dict(zip(
+        column(stim, 'timestamp').astype(float), stim_trace[:, 2 * CONTROL]
+        ))
+    flip_trace = column(traces, 'trace')
+    to_display = dict(zip(
+        column(traces, 'timestamp').astype(float), flip_trace[:, 2 * DISPLAY + 1]
+        ))
+    peaks = det_t - lag
+    control = np.array([to_control.get(t, np.nan) for t in det_t]) - peaks
+    display = np.array([to_display.get(t, np.nan) for t in det_t]) - peaks
+    control, display = control[np.isfinite(control)], display[np.isfinite(display)]
+
+    return dict(
+        n_peaks = int(peak_t.size),
+        n_detected = int(det_t.size),
+        n_displayed = int(display.size),
+        signal_lag = float(np.median(lag)) if lag.size else None,
+        signal_lag_ms = percentiles(lag, 1e3),
+        to_control_ms = percentiles(control, 1e3),
+        to_display_ms = percentiles(display, 1e3)
+    )
+
+def main(args):
+    # graph.py reads this at import, in this process and in the node processes
+    os.environ['CALIBRATION_RUN'] = str(args.duration)
+    # and to have them read our outlet, not an amplifier stream that's up too
+    source_id = 'calibrate-%s-%d'%(socket.gethostname(), os.getpid())
+    os.environ['CALIBRATION_SOURCE'] = source_id
+    import graph
+
+    ecg = simulate_ecg(
+        duration = args.recording,
+        sfreq = graph.POLLING_RATE,
+        heart_rate = args.heart_rate,
+        heart_rate_std = args.heart_rate_std,
+        noise = 0.,
+        seed = args.seed,
+        cache_dir = args.cache_dir
+        )
+    peaks = reference_peaks(ecg, graph.POLLING_RATE)
+    n_channels = max(graph.ECG_CHANNELS + [graph.ECG_CHANNEL]) + 1
+    outlet = SyntheticOutlet(
+        np.asarray(ecg) * 1e3, # amplifier streams microvolts
+        graph.POLLING_RATE,
+        source_id,
+        n_channels
+        )
+    outlet.start()
+
+    recording_name = 'calibration_%s'%strftime('%Y%m%d-%H%M%S')
+    options = lg.RunnerOptions(
+        logger_config = lg.LoggerConfig(
+            output_directory = LOG_DIR,
+            recording_name = recording_name,
+        ),
+    )
+    runner = lg.ParallelRunner(graph = graph.Experiment(), options = options)
+    try:
+        runner.run()
+    finally:
+        outlet.stop()
+
+    peak_t = outlet.peak_times(peaks)
+    peak_t = peak_t[peak_t >= outlet.t0 + args.warmup]
+    fpath = os.path.join(LOG_DIR, '%s.h5'%recording_name)
+    results = measure(fpath, peak_t, args.max_latency)
+    print(json.dumps(results, indent = 4))
+    if results['signal_lag'] is None:
+        print('no R-peaks were detected, so %s is unchanged'%args.out)
+        return
+
+    calibration = load_calibration(args.out)
+    if args.hardware_delay is not None:
+        calibration['hardware_delay'] = args.hardware_delay
+    # the decimator's delay is compensated for separately
+    detection_lag = results['signal_lag'] - graph.decimation_delay
+    calibration['detection_lag'] = max(detection_lag, 0.)
+    calibration['measured'] = dict(
+        commit = git_commit(),
+        date = strftime('%Y-%m-%dT%H:%M:%S'),
+        log = fpath,
+        fused = graph.FUSED,
+        decimation_delay = graph.decimation_delay,
+        results = results
+    )
+    save_calibration(calibration, args.out)
+    print('saved calibration to %s'%args.out)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--duration', type = float, default = 120.,
+        help = 'seconds of rivalry blocks to measure over')
+    parser.add_argument('--recording', type = float, default = 300.,
+        help = 'seconds of synthetic ECG to simulate (and loop)')
+    parser.add_argument('--heart-rate', type = float, default = 70.)
+    parser.add_argument('--heart-rate-std', type = float, default = 5.)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--cache-dir', type = str, default = '.cache')
+    parser.add_argument('--warmup', type = float, default = 5.,
+        help = 'seconds at the start of the stream not to score')
+    parser.add_argument('--max-latency', type = float, default = .25,
+        help = 'latest a detection can come after its R-peak, in seconds')
+    parser.add_argument('--hardware-delay', type = float, default = None,
+        help = 'amplifier delay to save, in seconds (default: keep the current one)')
+    parser.add_argument('--out', type = str, default = CALIBRATION_FILE)
+    args = parser.parse_args()
+    main(args)
@@ -1,90 +1,208 @@
 from typing import Tuple
 from time import strftime
 from typing import Dict
+import h5py
+import os
 
 from util.lsl import LSLPollerNode, LSLPollerConfig
+from util.decimate import Decimator, DecimatorConfig, decimator_delay
 from util.ecg import ECGSimulator, ECGConfig
+from util.replay import LogReplay, ReplayConfig
 from util.bandpass import BandPass, BandPassConfig
 from util.qrs import QRSDetector, QRSDetectorConfig
 from util.control import Control, ControlConfig
-from util.ui.display import Display
+from util.fused import FusedPipeline, FusedPipelineConfig
+from util.latency import LatencyMonitor, LatencyMonitorConfig
+from util.calibration import load_calibration
+from util.ui.display import Display, DisplayConfig
 import labgraph as lg
 
 SIMULATE = False
+REPLAY = None       # path to a log to play back instead of live/simulated ECG
+FUSED = False       # run filter, detector and controller in a single process
 ECG_CHANNEL = 0     # channel of LSL stream to use as ECG
+# or several channels, to automatically use whichever lead is cleanest
+ECG_CHANNELS = [ECG_CHANNEL]
 SFREQ = 100.        # desired sampling rate
 POLLING_RATE = 500. # lowest hardware rate of TMSi SAGA
+PREDICTIVE = True   # time stimuli from predicted as well as detected R-peaks
+CALIBRATION = load_calibration() # measured delays; run calibrate.py to update
+HARDWARE_DELAY = CALIBRATION['hardware_delay'] # amplifier delay
+DETECTION_LAG = CALIBRATION['detection_lag']   # R-peak to detection delay
+CONTINUOUS = False  # size stimuli continuously instead of in n_steps steps
 
-if SIMULATE:
+if REPLAY:
+    ecg_args = dict(path = REPLAY, sfreq = SFREQ)
+    ECGNode = LogReplay
+    ECGConfig = ReplayConfig
+    convert = True # logged ecg_raw is in the amplifier's units
+    decimation_delay = 0.
+elif SIMULATE:
     ecg_args = dict(sfreq = SFREQ)
     ECGNode = ECGSimulator
     ECGConfig = ECGConfig
     convert = False
+    decimation_delay = 0.
 else:
     downsample = POLLING_RATE / SFREQ
     assert(int(downsample) == downsample) # can only downsample by integer
     ecg_args = dict(
         sfreq = POLLING_RATE,
-        downsample = int(downsample)
+        chunk = True, # pull blocks and leave downsampling to the DECIMATOR
+        log_channels = ECG_CHANNELS # and log those blocks' ECG channels
     )
+    decimator_config = DecimatorConfig(
+        factor = int(downsample),
+        sfreq = POLLING_RATE
+    )
+    decimation_delay = decimator_delay(decimator_config)
     ECGNode = LSLPollerNode
     ECGConfig = LSLPollerConfig
     convert = True # convert units from microvolts to mV in filter node 
+LIVE = not (SIMULATE or REPLAY)
+# set by calibrate.py, which runs the graph on synthetic ECG for this long
+CALIBRATION_RUN = float(os.environ.get('CALIBRATION_RUN', 0.))
+# and streams it from an outlet with this source_id, which is read instead of
+# whatever amplifier stream might also be up
+CALIBRATION_SOURCE = os.environ.get('CALIBRATION_SOURCE', '')
+if LIVE and CALIBRATION_SOURCE:
+    ecg_args['source_id'] = CALIBRATION_SOURCE
 
 class Experiment(lg.Graph):
 
     GENERATOR: ECGNode
-    FILTER: BandPass
-    DETECTOR: QRSDetector
-    CONTROLLER: Control
+    if LIVE:
+        DECIMATOR: Decimator
+    if FUSED:
+        PIPELINE: FusedPipeline
+    else:
+        FILTER: BandPass
+        DETECTOR: QRSDetector
+        CONTROLLER: Control
     DISPLAY: Display
+    LATENCY: LatencyMonitor
 
     def setup(self) -> None:
 
         self.GENERATOR.configure(
             ECGConfig(**ecg_args)
         )
-        self.FILTER.configure(
-            BandPassConfig(
-                low_cutoff = 5.,
-                high_cutoff = 15.,
-                sfreq = SFREQ,
-                ch_idx = ECG_CHANNEL,
-                convert_microV_to_mV = convert
-            )
+        if LIVE:
+            self.DECIMATOR.configure(decimator_config)
+        filter_config = BandPassConfig(
+            low_cutoff = 5.,
+            high_cutoff = 15.,
+            sfreq = SFREQ,
+            ch_idx = ECG_CHANNEL,
+            channels = ECG_CHANNELS,
+            convert_microV_to_mV = convert
         )
-        self.DETECTOR.configure(
-            QRSDetectorConfig(
-                sfreq = SFREQ
-            )
+        detector_config = QRSDetectorConfig(
+            sfreq = SFREQ
+        )
+        control_config = ControlConfig(
+            # minus hardware delay and anti-aliasing filter delay
+            systole_lag = .210 - HARDWARE_DELAY - decimation_delay,
+            predictive = PREDICTIVE,
+            detection_lag = DETECTION_LAG
         )
-        self.CONTROLLER.configure(
-            ControlConfig(
-                systole_lag = .210 - .035 # minus 35 ms hardware delay
+        if FUSED:
+            self.PIPELINE.configure(
+                FusedPipelineConfig(
+                    filter = filter_config,
+                    detector = detector_config,
+                    control = control_config
+                )
             )
+        else:
+            self.FILTER.configure(filter_config)
+            self.DETECTOR.configure(detector_config)
+            self.CONTROLLER.configure(control_config)
+        if CALIBRATION_RUN: # just the two rivalry blocks
+            self.DISPLAY.configure(DisplayConfig(
+                continuous = CONTINUOUS,
+                duration = CALIBRATION_RUN / 2,
+                trials = 0
+            ))
+        else:
+            self.DISPLAY.configure(DisplayConfig(continuous = CONTINUOUS))
+        self.LATENCY.configure(LatencyMonitorConfig())
+
+    # Topics of the processing chain, wherever it runs
+    def chain_topics(self) -> Dict[str, lg.Topic]:
+        if FUSED:
+            return dict(
+                input = self.PIPELINE.INPUT,
+                ecg_filt = self.PIPELINE.FILTER_OUTPUT,
+                ecg_lead = self.PIPELINE.LEAD_OUTPUT,
+                t_since = self.PIPELINE.DETECTOR_OUTPUT,
+                stim_size = self.PIPELINE.OUTPUT
+            )
+        return dict(
+            input = self.FILTER.INPUT,
+            ecg_filt = self.FILTER.OUTPUT,
+            ecg_lead = self.FILTER.LEAD_OUTPUT,
+            t_since = self.DETECTOR.OUTPUT,
+            stim_size = self.CONTROLLER.OUTPUT
         )
 
     # Connect outputs to inputs
     def connections(self) -> lg.Connections:
-        return (
-            (self.GENERATOR.OUTPUT, self.FILTER.INPUT),
-            (self.FILTER.OUTPUT, self.DETECTOR.INPUT),
-            (self.DETECTOR.OUTPUT, self.CONTROLLER.INPUT),
-            (self.CONTROLLER.OUTPUT, self.DISPLAY.DISPLAY_TOPIC)
+        topics = self.chain_topics()
+        if not LIVE:
+            source = ((self.GENERATOR.OUTPUT, topics['input']),)
+        else:
+            source = (
+                (self.GENERATOR.CHUNK_OUTPUT, self.DECIMATOR.CHUNK_INPUT),
+                (self.DECIMATOR.OUTPUT, topics['input']),
+            )
+        if not FUSED:
+            source += (
+                (self.FILTER.OUTPUT, self.DETECTOR.INPUT),
+                (self.FILTER.LEAD_OUTPUT, self.DETECTOR.LEAD_INPUT),
+                (self.DETECTOR.OUTPUT, self.CONTROLLER.INPUT),
+            )
+        return source + (
+            (topics['stim_size'], self.DISPLAY.DISPLAY_TOPIC),
+            (self.DISPLAY.TRACE_OUTPUT, self.LATENCY.INPUT),
         )
 
     # Parallelization: Run nodes in separate processes
     def process_modules(self) -> Tuple[lg.Module, ...]:
-        return (self.GENERATOR, self.FILTER, self.DETECTOR, self.CONTROLLER, self.DISPLAY)
+        if not LIVE:
+            source = (self.GENERATOR,)
+        else:
+            source = (self.GENERATOR, self.DECIMATOR)
+        if FUSED: # no inter-process hops between processing stages
+            chain = (self.PIPELINE,)
+        else:
+            chain = (self.FILTER, self.DETECTOR, self.CONTROLLER)
+        return source + chain + (self.DISPLAY, self.LATENCY)
 
     def logging(self) -> Dict[str, lg.Topic]:
-        return {
+        topics = self.chain_topics()
+        logs = {
             'ecg_raw': self.GENERATOR.OUTPUT,
-            'ecg_filt': self.FILTER.OUTPUT,
-            't_since': self.DETECTOR.OUTPUT,
-            'stim_size': self.CONTROLLER.OUTPUT,
+            'ecg_filt': topics['ecg_filt'],
+            'ecg_lead': topics['ecg_lead'],
+            't_since': topics['t_since'],
+            'stim_size': topics['stim_size'],
+            # when each frame went up and what it showed
+            'frames': self.DISPLAY.FLIP_OUTPUT,
             'experiment_events': self.DISPLAY.EXPERIMENT_EVENTS,
+            # per-stage timing of each sample that reached the display
+            'latency_trace': self.DISPLAY.TRACE_OUTPUT,
+            'latency': self.LATENCY.OUTPUT,
+            'display_stats': self.DISPLAY.STATS_OUTPUT,
             }
+        if SIMULATE or LIVE: # how well the source is keeping up
+            logs['source_stats'] = self.GENERATOR.STATS_OUTPUT
+        if LIVE:
+            # keep the full-rate recording too, but ecg_raw stays at SFREQ
+            logs['ecg_raw'] = self.DECIMATOR.OUTPUT
+            logs['ecg_chunks'] = self.GENERATOR.LOG_OUTPUT
+            logs['clock_sync'] = self.GENERATOR.CLOCK_OUTPUT
+        return logs
 
 # Entry point: run the Demo graph
 if __name__ == "__main__":
@@ -92,11 +210,16 @@ if __name__ == "__main__":
     sub_num = int(sub_num)
     sub = '%02d'%sub_num
     graph = Experiment()
+    recording_name = 'sub-%s_%s'%(sub, strftime('%Y%m%d-%H%M%S'))
     options = lg.RunnerOptions(
         logger_config = lg.LoggerConfig(
             output_directory = './logs', # label w/ subject number and datetime
-            recording_name = 'sub-%s_%s'%(sub, strftime('%Y%m%d-%H%M%S')),
+            recording_name = recording_name,
         ),
     )
     runner = lg.ParallelRunner(graph = graph, options = options)
     runner.run()
+    # how far the logged ECG lags its timestamps, for bidsify.py to undo
+    with h5py.File(os.path.join('./logs', '%s.h5'%recording_name), 'a') as f:
+        f.attrs['hardware_delay'] = HARDWARE_DELAY
+        f.attrs['decimation_delay'] = decimation_delay
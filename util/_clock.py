@@ -0,0 +1,94 @@
+from pylsl import local_clock
+import threading
+import numpy as np
+
+class ClockSync(object):
+    """
+    Maps timestamps from a remote LSL stream onto the local clock.
+
+    A background thread queries `inlet.time_correction()` every `interval`
+    seconds and fits offset + drift * (t - t0) to the estimates, as a running
+    least squares fit in which older estimates are exponentially forgotten.
+    Mapping a timestamp (or an array of them) is then a single multiply-add
+    and never waits on the network.
+    """
+    def __init__(self, inlet, interval: float = 5., memory: float = 60.):
+        """
+        Constructor.
+        @param inlet: the inlet whose clock to track
+        @type  inlet: pylsl.StreamInlet
+        @param interval: seconds between offset estimates
+        @type  interval: float
+        @param memory: roughly how many estimates the fit averages over
+        @type  memory: float
+        """
+        self.inlet = inlet
+        self.interval = interval
+        self._forget = 1. - 1. / memory
+        self._sums = np.zeros(5) # n, x, x^2, y, xy
+        self._stop = threading.Event()
+        self._thread = None
+        self.t0 = None # remote time the model is centered on
+        # (t0, offset at t0, change in offset per second), swapped as a whole
+        self.params = (0., 0., 0.)
+        self.n_updates = 0
+        self._map = (1., 0.) # gain and bias, swapped in as one tuple
+
+    def update(self, offset: float, t: float = None) -> None:
+        """
+        Add an offset estimate to the fit.
+        @param offset: remote-to-local offset, as from `time_correction()`
+        @type  offset: float
+        @param t: local time at which the offset was estimated
+        @type  t: float
+        """
+        if t is None:
+            t = local_clock()
+        t_remote = t - offset
+        if self.t0 is None:
+            self.t0 = t_remote
+        x = t_remote - self.t0
+        self._sums *= self._forget
+        self._sums += (1., x, x * x, offset, x * offset)
+        n, sx, sxx, sy, sxy = self._sums
+        den = n * sxx - sx * sx
+        if den > 1e-12 * n * n:
+            drift = (n * sxy - sx * sy) / den
+        else: # not enough spread in time yet to estimate a drift
+            drift = 0.
+        offset = (sy - drift * sx) / n
+        self.params = (self.t0, offset, drift)
+        # local = t + offset + drift * (t - t0)
+        self._map = (1. + drift, offset - drift * self.t0)
+        self.n_updates += 1
+
+    def __call__(self, t):
+        """
+        Map remote timestamp(s) onto the local clock.
+        @param t: remote timestamp(s)
+        @type  t: float or np.ndarray
+        @rtype: float or np.ndarray
+        """
+        gain, bias = self._map
+        return t * gain + bias
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                offset = self.inlet.time_correction(timeout = self.interval)
+            except Exception: # lost the stream or timed out; try again later
+                continue
+            self.update(offset)
+
+    def start(self) -> None:
+        """
+        Make a first (blocking) estimate, then keep refining it in the background.
+        """
+        self.update(self.inlet.time_correction())
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
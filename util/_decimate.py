@@ -0,0 +1,105 @@
+from scipy.signal import firwin
+from numpy.lib.stride_tricks import as_strided
+import numpy as np
+
+
+def fill_nonfinite(x, last):
+    """
+    Replace non-finite values in each column of `x` with the most recent
+    finite value before them, using `last` for values at the start of the block.
+    @param x: samples, (n_samples, n_channels)
+    @type  x: np.ndarray
+    @param last: the last sample seen before this block, (n_channels,)
+    @type  last: np.ndarray
+    @return: x with NaNs and infs forward-filled
+    @rtype: np.ndarray
+    """
+    bad = ~np.isfinite(x)
+    if not bad.any():
+        return x
+    x = np.concatenate((last[None, :], x))
+    bad = np.concatenate((np.zeros((1, x.shape[1]), dtype = bool), bad))
+    rows = np.where(bad, 0, np.arange(x.shape[0])[:, None])
+    rows = np.maximum.accumulate(rows, axis = 0)
+    x = x[rows, np.arange(x.shape[1])]
+    return x[1:]
+
+class PolyphaseDecimator(object):
+    """
+    Stateful FIR anti-aliasing filter and decimator for blocks of samples.
+
+    Only the output samples that are kept are ever computed: each one is a dot
+    product of the filter taps with a strided view onto the input, so the cost
+    is (n_samples / factor) * numtaps per channel and blocks of any size can be
+    passed in. The last numtaps - 1 input samples and the decimation phase are
+    carried over between calls, so the output does not depend on how the input
+    was split into blocks.
+    """
+    def __init__(self, factor: int, numtaps: int, sfreq: float,
+                 cutoff: float = .8):
+        """
+        Constructor.
+        @param factor: keep one of every `factor` samples
+        @type  factor: int
+        @param numtaps: length of the (linear phase) FIR filter
+        @type  numtaps: int
+        @param sfreq: input sampling rate
+        @type  sfreq: float
+        @param cutoff: filter cutoff as a fraction of the output Nyquist rate
+        @type  cutoff: float
+        """
+        self.factor = factor
+        self.sfreq = sfreq
+        if factor > 1:
+            self.taps = firwin(numtaps, cutoff * sfreq / factor / 2., fs = sfreq)
+        else:
+            self.taps = np.ones(1)
+        self._kernel = self.taps[::-1].copy()
+        self._buf = None # last len(taps) - 1 input samples
+        self._last = None # last finite input sample
+        self._phase = factor - 1 # index into next block of next kept sample
+
+    @property
+    def delay(self):
+        """
+        Group delay of the filter in seconds, which is constant since the
+        filter is linear phase.
+        @rtype: float
+        """
+        return (self.taps.size - 1) / 2. / self.sfreq
+
+    def filter(self, x: np.ndarray):
+        """
+        Filter and decimate a block of samples.
+        @param x: samples, (n_samples, n_channels)
+        @type  x: np.ndarray
+        @return: decimated samples (n_out, n_channels), and the index into
+            `x` that each output sample lines up with (for timestamps)
+        @rtype: Tuple[np.ndarray, np.ndarray]
+        """
+        n, n_ch = x.shape
+        if n == 0: # nothing to filter, and no last sample to keep
+            return np.empty((0, n_ch)), np.empty(0, dtype = int)
+        n_hist = self.taps.size - 1
+        if self._buf is None:
+            self._buf = np.zeros((n_hist, n_ch))
+            self._last = np.zeros(n_ch)
+        x = fill_nonfinite(np.asarray(x, dtype = float), self._last)
+        self._last = x[-1]
+        xb = np.ascontiguousarray(np.concatenate((self._buf, x)))
+        idx = np.arange(self._phase, n, self.factor)
+        if idx.size:
+            s0, s1 = xb.strides
+            windows = as_strided(
+                xb[self._phase:],
+                shape = (idx.size, self.taps.size, n_ch),
+                strides = (self.factor * s0, s0, s1),
+                writeable = False
+                )
+            y = np.tensordot(windows, self._kernel, axes = ([1], [0]))
+            self._phase = idx[-1] + self.factor - n
+        else:
+            y = np.empty((0, n_ch))
+            self._phase -= n
+        self._buf = xb[xb.shape[0] - n_hist:].copy()
+        return y, idx
@@ -0,0 +1,86 @@
+import numpy as np
+
+class IBIPredictor(object):
+    """
+    Forecasts the next inter-beat interval from a ring buffer of recent ones.
+
+    The prediction is the median of the buffer. Intervals that are out of
+    physiological range, or too far from the median in units of the median
+    absolute deviation, are rejected as missed or spurious detections. If
+    several intervals in a row are rejected, the heart rate has probably
+    changed, so the buffer is cleared and refilled.
+
+    `confidence` goes from 0 to 1. It is low while the buffer is filling up,
+    when recent intervals vary a lot, and after rejected intervals.
+    """
+    def __init__(self, size: int = 8, min_ibi: float = .3, max_ibi: float = 2.,
+                 max_dev: float = 3., max_cv: float = .1):
+        """
+        Constructor.
+        @param size: number of recent intervals to keep
+        @type  size: int
+        @param min_ibi: shortest plausible interval, in seconds
+        @type  min_ibi: float
+        @param max_ibi: longest plausible interval, in seconds
+        @type  max_ibi: float
+        @param max_dev: how many (scaled) MADs from the median an interval can
+            be before it's rejected
+        @type  max_dev: float
+        @param max_cv: variability, relative to the median, at which
+            confidence drops to zero
+        @type  max_cv: float
+        """
+        self._ibis = np.zeros(size)
+        self._idx = 0
+        self._n = 0
+        self.min_ibi = min_ibi
+        self.max_ibi = max_ibi
+        self.max_dev = max_dev
+        self.max_cv = max_cv
+        self.rejected = 0 # intervals rejected in a row
+        self.prediction = np.nan
+        self.spread = np.nan
+        self.confidence = 0.
+
+    def _refresh(self) -> None:
+        ibis = self._ibis[:self._n]
+        self.prediction = np.median(ibis)
+        # scaled so it estimates the standard deviation of normal data
+        self.spread = 1.4826 * np.median(np.abs(ibis - self.prediction))
+        cv = self.spread / self.prediction
+        fill = self._n / self._ibis.size
+        self.confidence = fill * max(0., 1. - cv / self.max_cv) \
+                          * .5 ** self.rejected
+
+    def update(self, ibi: float) -> bool:
+        """
+        Add a newly measured interval.
+        @param ibi: time between the last two detected R-peaks, in seconds
+        @type  ibi: float
+        @return: whether the interval was accepted
+        @rtype: bool
+        """
+        ok = self.min_ibi <= ibi <= self.max_ibi
+        if ok and self._n >= 3:
+            # floor on the spread, so a very steady rhythm doesn't reject
+            # ordinary beat-to-beat variability
+            tol = max(self.spread, .05 * self.prediction)
+            ok = abs(ibi - self.prediction) <= self.max_dev * tol
+        if not ok:
+            self.rejected += 1
+            if self.rejected >= self._ibis.size // 2: # rhythm has changed
+                self._n = 0
+                self._idx = 0
+                self.rejected = 0
+                self.prediction = np.nan
+                self.spread = np.nan
+                self.confidence = 0.
+            elif self._n:
+                self._refresh()
+            return False
+        self.rejected = 0
+        self._ibis[self._idx] = ibi
+        self._idx = (self._idx + 1) % self._ibis.size
+        self._n = min(self._n + 1, self._ibis.size)
+        self._refresh()
+        return True
@@ -0,0 +1,114 @@
+from collections import deque
+import numpy as np
+
+class MovingIntegral(object):
+    """
+    Streaming derivative, squaring and moving-window integration stages of
+    the Pan-Tompkins algorithm, over a sliding buffer of the last
+    `buffer_size` input samples.
+
+    Each new sample costs O(1): the squared derivative goes into a doubled
+    ring buffer (so the whole buffer is always one contiguous view, never a
+    copy) and the integral is kept as a running sum. A monotonic queue holds
+    the running maximum of the integral over the samples that can make up
+    the detector's search window, which gives a cheap upper bound on the
+    height of any peak `find_peaks` could find there.
+
+    `integrate` returns exactly what the batch implementation computes from
+    the same buffer, since peak selection (with its minimum spacing) depends
+    on every peak in the buffer and not just the recent ones.
+    """
+    # rebuild the running sum from scratch this often, in buffer lengths, so
+    # rounding errors can't accumulate
+    REFRESH = 4
+
+    def __init__(self, buffer_size: int, integration_win: int,
+                 detection_window: int):
+        """
+        Constructor.
+        @param buffer_size: number of input samples kept, as in the batch detector
+        @type  buffer_size: int
+        @param integration_win: length of the moving-window integrator, in samples
+        @type  integration_win: int
+        @param detection_window: peaks are only searched for in the last
+            `detection_window` samples of a full buffer
+        @type  detection_window: int
+        """
+        self.buffer_size = buffer_size
+        self.integration_win = integration_win
+        self._kernel = np.ones(integration_win)
+        # squared derivatives; there is one fewer of them than buffered samples
+        self._size = buffer_size - 1
+        self._ring_len = max(self._size, integration_win + 1)
+        self._ring = np.zeros(2 * self._ring_len)
+        self._head = 0 # where the next value goes
+        self._n = 0 # how many values the buffer holds
+        # the buffer starts out holding a single zero
+        self._last_x = 0.
+        self._sum = 0.
+        self._scale = 0. # largest running sum since the last refresh
+        self._until_refresh = self.REFRESH * buffer_size
+        # (sample count, running sum) pairs, decreasing in running sum
+        self._maxima = deque()
+        self._count = 0
+        # integrals of the first output sample in the search window onwards
+        # only involve the last `_span` moving sums (and partial sums of the
+        # last one, which can't be any larger)
+        self._span = max(detection_window - 2, 1)
+
+    def append(self, x: float) -> None:
+        """
+        Add a new input sample to the buffer.
+        @param x: the sample
+        @type  x: float
+        """
+        x = float(x)
+        d = x - self._last_x
+        self._last_x = x
+        sq = d * d
+        R = self._ring_len
+        # value integration_win samples ago, about to leave the window
+        old = self._ring[self._head + R - self.integration_win]
+        self._ring[self._head] = sq
+        self._ring[self._head + R] = sq
+        self._head = (self._head + 1) % R
+        self._n = min(self._n + 1, self._size)
+        self._count += 1
+
+        self._until_refresh -= 1
+        if self._until_refresh <= 0:
+            self._sum = self._ring[self._head + R - self.integration_win:
+                                   self._head + R].sum()
+            self._scale = self._sum
+            self._until_refresh = self.REFRESH * self.buffer_size
+        else:
+            self._sum += sq - old
+            self._scale = max(self._scale, self._sum)
+
+        maxima = self._maxima
+        while maxima and maxima[-1][1] <= self._sum:
+            maxima.pop()
+        maxima.append((self._count, self._sum))
+        while maxima[0][0] <= self._count - self._span:
+            maxima.popleft()
+
+    def could_exceed(self, limit: float) -> bool:
+        """
+        Whether any value in the search window of `integrate()` might reach
+        `limit`. Errs on the side of True, so a False is always safe to act on.
+        @param limit: minimum peak height
+        @type  limit: float
+        @rtype: bool
+        """
+        # allow for rounding differences between the running sum and np.convolve
+        tol = 1e-9 * (self._scale + abs(limit))
+        return self._maxima[0][1] >= limit - tol
+
+    def integrate(self) -> np.ndarray:
+        """
+        @return: the moving-window integral of the squared derivative of the
+            buffered samples, as np.convolve(np.ediff1d(xs)**2, ones) gives it
+        @rtype: np.ndarray
+        """
+        end = self._head + self._ring_len
+        return np.convolve(self._ring[end - self._n:end], self._kernel)
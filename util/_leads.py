@@ -0,0 +1,129 @@
+import numpy as np
+
+class LeadSelector(object):
+    """
+    Tracks a running signal quality score for each of several (bandpassed)
+    ECG leads and picks which one to pass on to the R-peak detector.
+
+    A lead's score is its typical beat amplitude over its noise: the mean
+    rectified level of the bandpassed lead (dominated by the noise floor
+    between beats) plus that of its out-of-band, high-frequency content
+    (muscle and motion artifacts, electrode pops), if given. The beat
+    amplitude is the geometric running mean of the largest value in each
+    `beat_window` seconds, which a clean lead's R-peaks keep steady. A
+    one-off spike only moves it by a fraction of its log, while raising the
+    noise terms, so an artifact lowers a lead's score instead of raising it.
+    A flat or disconnected lead scores zero.
+
+    The current lead is only swapped when another one has scored
+    `hysteresis` times better, and at most every `min_dwell` seconds, so the
+    detector isn't switched back and forth between similar leads.
+
+    Updating costs a handful of vectorized operations per sample or per
+    block, whatever the number of leads, so switching never holds up the
+    pipeline.
+    """
+    def __init__(self, n_leads: int, sfreq: float, window: float = 8.,
+                 beat_window: float = 1.5, hysteresis: float = 1.5,
+                 min_dwell: float = 5.):
+        """
+        Constructor.
+        @param n_leads: number of leads to choose from
+        @type  n_leads: int
+        @param sfreq: sampling rate
+        @type  sfreq: float
+        @param window: time constant of the running scores, in seconds
+        @type  window: float
+        @param beat_window: time over which to take each maximum, in seconds;
+            long enough to hold a beat at the slowest plausible heart rate
+        @type  beat_window: float
+        @param hysteresis: how many times better a lead has to score to take over
+        @type  hysteresis: float
+        @param min_dwell: shortest time to stay on a lead, in seconds
+        @type  min_dwell: float
+        """
+        self._decay = np.exp(-1. / (window * sfreq))
+        self._alpha = 1. - np.exp(-beat_window / window)
+        self._beat_n = int(beat_window * sfreq)
+        self._win_max = np.zeros(n_leads)
+        self._win_n = 0
+        self._log_peak = np.full(n_leads, np.nan) # until the first window ends
+        self._level = np.zeros(n_leads)
+        self._noise = np.zeros(n_leads)
+        self._hysteresis = hysteresis
+        self._min_dwell = int(min_dwell * sfreq)
+        self._since_switch = 0
+        self.lead = 0
+
+    @property
+    def scores(self) -> np.ndarray:
+        if np.isnan(self._log_peak).any():
+            return np.zeros(self._level.size)
+        noise = self._level + self._noise
+        return np.where(
+            noise > 1e-12, np.exp(self._log_peak) / np.maximum(noise, 1e-12), 0.
+            )
+
+    def _update_peak(self, a_max: np.ndarray, n: int) -> None:
+        np.maximum(self._win_max, a_max, out = self._win_max)
+        self._win_n += n
+        if self._win_n < self._beat_n:
+            return
+        log_max = np.log(np.maximum(self._win_max, 1e-12))
+        if np.isnan(self._log_peak).any():
+            self._log_peak = log_max
+        else:
+            self._log_peak += self._alpha * (log_max - self._log_peak)
+        self._win_max[:] = 0.
+        self._win_n = 0
+
+    def _choose(self, n: int) -> bool:
+        self._since_switch += n
+        if self._since_switch < self._min_dwell:
+            return False
+        scores = self.scores
+        best = int(np.argmax(scores))
+        if scores[best] > self._hysteresis * scores[self.lead]:
+            self.lead = best
+            self._since_switch = 0
+            return True
+        return False
+
+    def update(self, y: np.ndarray, hf: np.ndarray = None) -> bool:
+        """
+        Update the scores with one sample from each lead.
+        @param y: filtered sample from each lead, (n_leads,)
+        @type  y: np.ndarray
+        @param hf: high-passed (above the ECG band) sample from each lead
+        @type  hf: np.ndarray
+        @return: whether `lead` changed
+        @rtype: bool
+        """
+        a = np.abs(y)
+        self._level += (1. - self._decay) * (a - self._level)
+        if hf is not None:
+            self._noise += (1. - self._decay) * (np.abs(hf) - self._noise)
+        self._update_peak(a, 1)
+        return self._choose(1)
+
+    def update_block(self, y: np.ndarray, hf: np.ndarray = None) -> bool:
+        """
+        Update the scores with a block of samples, treating the block as one
+        step of the running averages.
+        @param y: filtered samples, (n_samples, n_leads)
+        @type  y: np.ndarray
+        @param hf: high-passed samples, (n_samples, n_leads)
+        @type  hf: np.ndarray
+        @return: whether `lead` changed
+        @rtype: bool
+        """
+        n = y.shape[0]
+        if not n:
+            return False
+        a = np.abs(y)
+        decay = self._decay ** n
+        self._level += (1. - decay) * (a.mean(axis = 0) - self._level)
+        if hf is not None:
+            self._noise += (1. - decay) * (np.abs(hf).mean(axis = 0) - self._noise)
+        self._update_peak(a.max(axis = 0), n)
+        return self._choose(n)
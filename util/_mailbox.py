@@ -0,0 +1,63 @@
+import threading
+
+class Mailbox(object):
+    """
+    A conflating, latest-value input: holds only the newest item put in it,
+    for a consumer (e.g. a render loop) that only ever cares about the
+    latest one and takes it at its own pace.
+
+    Putting is O(1) whatever the consumer is doing, so a backlog of messages
+    delivered after a stall is drained straight away instead of being acted
+    on one by one. Counts of what happened to the items are kept for
+    reporting how often the consumer falls behind.
+    """
+    def __init__(self):
+        """
+        Constructor.
+        """
+        self._lock = threading.Lock()
+        self._item = None
+        self._t = None # timestamp of newest item received
+        self._fresh = False # whether _item hasn't been taken yet
+        self._counts = dict(received = 0, taken = 0, coalesced = 0, dropped = 0)
+
+    def put(self, item, t: float) -> None:
+        """
+        Offer a new item. It replaces the held item unless it's older.
+        @param item: the item
+        @param t: its timestamp
+        @type  t: float
+        """
+        with self._lock:
+            self._counts['received'] += 1
+            if self._t is not None and t < self._t: # out of order
+                self._counts['dropped'] += 1
+                return
+            if self._fresh: # replaced before the consumer got to it
+                self._counts['coalesced'] += 1
+            self._item = item
+            self._t = t
+            self._fresh = True
+
+    def take(self):
+        """
+        @return: the newest item, if it hasn't been taken already, else None
+        """
+        with self._lock:
+            if not self._fresh:
+                return None
+            self._fresh = False
+            self._counts['taken'] += 1
+            return self._item
+
+    def stats(self) -> dict:
+        """
+        @return: counts of items received, taken, coalesced (replaced before
+            being taken) and dropped (older than one already received) since
+            the last call
+        @rtype: dict
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = {k: 0 for k in counts}
+        return counts
@@ -1,4 +1,7 @@
+from dataclasses import field
 import numpy as np
+
+from ._trace import new_trace
 import labgraph as lg
 
 
@@ -9,6 +12,31 @@ class SampleMessage(lg.TimestampedMessage):
     '''
     #timestamp: float
     data: np.ndarray
+    trace: np.ndarray = field(default_factory = new_trace) # see _trace.py
+
+class SampleChunkMessage(lg.TimestampedMessage):
+    '''
+    A block of raw data samples, as pulled from an LSL inlet in one go.
+    `data` is (n_samples, n_channels) and `timestamps` holds the time of
+    each row; `timestamp` is the time of the last sample in the block.
+    '''
+    # timestamp: float
+    data: np.ndarray
+    timestamps: np.ndarray
+    trace: np.ndarray = field(default_factory = new_trace)
+
+class ChannelChunkMessage(lg.TimestampedMessage):
+    '''
+    Some channels of a block of raw data samples, for logging. The logger
+    only keeps the first `shape[0]` values of an array, so `data` is
+    flattened: it holds all of the first channel's samples, then all of the
+    next one's, in the order of `channels`, i.e. it reshapes to
+    (len(channels), len(timestamps)).
+    '''
+    # timestamp: float
+    timestamps: np.ndarray
+    channels: np.ndarray
+    data: np.ndarray
 
 class StringMessage(lg.TimestampedMessage):
     '''
@@ -26,6 +54,7 @@ class FloatMessage(lg.TimestampedMessage):
     '''
     # timestamp: float
     data: float
+    trace: np.ndarray = field(default_factory = new_trace)
 
 class DisplayMessage(lg.TimestampedMessage):
     '''
@@ -35,9 +64,113 @@ class DisplayMessage(lg.TimestampedMessage):
     sz_sync: float
     sz_async: float
     process_t: float
+    trace: np.ndarray = field(default_factory = new_trace)
+    # the cardiac phase model the sizes came from, as of `timestamp`, so the
+    # sizes can be recomputed for a later time (see control.stimulus_size)
+    t_since: float = np.nan # seconds since last R-peak
+    ibi: float = np.nan # predicted interval to next R-peak, if any
+    sync_lag: float = np.nan
+    async_lag: float = np.nan
+    scale: float = np.nan
 
 class ExperimentEventMessage(lg.TimestampedMessage):
-    # timestamp: float
+    # timestamp: float (when the event happened, on the LSL clock)
     key: str
-    key_t: float
+    key_t: float # same as timestamp
     sync_side: str
+
+class ClockSyncMessage(lg.TimestampedMessage):
+    '''
+    Parameters of the model mapping a remote LSL clock onto the local clock,
+    local = remote + offset + drift * (remote - t0), so offline code can
+    apply the same mapping.
+    '''
+    # timestamp: float
+    t0: float
+    offset: float
+    drift: float
+
+class PollerStatsMessage(lg.TimestampedMessage):
+    '''
+    Health of an acquisition node over the last reporting interval.
+    '''
+    # timestamp: float
+    stall_time: float # longest gap between data arrivals, in seconds
+    queue_depth: int # messages waiting to be published right now
+    max_queue_depth: int # most messages waiting at once during the interval
+    n_samples: int # samples received during the interval
+
+class RateStatsMessage(lg.TimestampedMessage):
+    '''
+    How late a fixed-rate loop has been waking up for its deadlines.
+    '''
+    # timestamp: float
+    p50: float # lateness percentiles, in seconds
+    p95: float
+    p99: float
+    max_lateness: float
+    missed: int # deadlines missed so far
+    ticks: int # ticks so far
+
+class LeadMessage(lg.TimestampedMessage):
+    '''
+    Which channel is being passed on as the ECG, and the signal quality
+    scores of all candidate channels that the choice was based on.
+    '''
+    # timestamp: float
+    lead: int
+    scores: np.ndarray
+
+class TraceMessage(lg.TimestampedMessage):
+    '''
+    The latency trace of a sample that has made it all the way to the screen.
+    '''
+    # timestamp: float
+    trace: np.ndarray
+
+class LatencyMessage(lg.TimestampedMessage):
+    '''
+    Rolling latency percentiles (p50, p95, p99 in seconds) over the last `n`
+    traced samples. `stage_*` is the time spent in each stage, `wait_*` the
+    time between the previous stage handing the sample on (or its
+    acquisition) and each stage getting it, each with one value per stage in
+    the order of _trace.STAGES. `total` is from acquisition to leaving the
+    display node, as [p50, p95, p99]. (They're separate 1-D arrays because
+    the logger only keeps the first `shape[0]` values of an array.)
+    '''
+    # timestamp: float
+    n: int
+    stage_p50: np.ndarray
+    stage_p95: np.ndarray
+    stage_p99: np.ndarray
+    wait_p50: np.ndarray
+    wait_p95: np.ndarray
+    wait_p99: np.ndarray
+    total: np.ndarray
+
+class MailboxStatsMessage(lg.TimestampedMessage):
+    '''
+    What happened to the messages sent to a latest-value input over the last
+    reporting interval.
+    '''
+    # timestamp: float
+    received: int
+    taken: int # acted on
+    coalesced: int # replaced by a newer message before being acted on
+    dropped: int # arrived out of order, older than one already received
+
+class FlipMessage(lg.TimestampedMessage):
+    '''
+    A batch of display frames: when each was flipped onto the screen (on the
+    LSL clock), the time since the flip before it, and the stimulus sizes and
+    steps it showed. `timestamp` is the time of the last flip in the batch.
+    Every field is a 1-D float array with one value per flip, since the logger
+    only keeps the first `shape[0]` values of an array.
+    '''
+    # timestamp: float
+    flip_t: np.ndarray
+    interval: np.ndarray # NaN for the first flip
+    sz_sync: np.ndarray
+    sz_async: np.ndarray
+    step_left: np.ndarray
+    step_right: np.ndarray
@@ -1,56 +1,104 @@
+import numpy as np
 import time
 import asyncio
 
 class Rate(object):
     """
-    Convenience class for sleeping in a loop at a specified rate
+    Convenience class for sleeping in a loop at a specified rate.
+
+    Ticks are scheduled against absolute deadlines on a monotonic clock, so
+    wall clock adjustments can't disturb the loop and small delays don't
+    accumulate into drift. When the loop falls more than a period behind, the
+    catch-up policy decides what happens to the deadlines it missed:
+
+    - 'burst':    run the missed ticks back to back until caught up
+    - 'skip':     drop the missed ticks and wait for the next deadline on the
+                  original schedule
+    - 'coalesce': run one tick now that stands in for all the missed ones
+                  (`sleep` returns how many), and carry on with the original
+                  schedule
+
+    How late each tick woke up is kept for the last `window` ticks, so loops
+    can report whether they are keeping up.
     """
-    def __init__(self, hz: float):
+    POLICIES = ('burst', 'skip', 'coalesce')
+
+    def __init__(self, hz: float, policy: str = 'coalesce', window: int = 1000):
         """
         Constructor.
         @param hz: hz rate to determine sleeping
         @type  hz: float
+        @param policy: what to do about missed deadlines (see above)
+        @type  policy: str
+        @param window: how many ticks to keep lateness statistics over
+        @type  window: int
         """
-        self.last_time = time.time()
+        if policy not in self.POLICIES:
+            raise ValueError(
+                'policy must be one of %s, not %s'%(', '.join(self.POLICIES), policy)
+                )
         self.sleep_dur = 1.0 / hz
-
-    def _remaining(self, curr_time: float):
-        """
-        Calculate the time remaining for rate to sleep.
-        @param curr_time: current time
-        @type  curr_time: float
-        @return: time remaining
-        @rtype: float
-        """
-        # detect time jumping backwards
-        if self.last_time > curr_time:
-            self.last_time = curr_time
-
-        # calculate remaining time
-        elapsed = curr_time - self.last_time
-        return self.sleep_dur - elapsed
+        self.policy = policy
+        self.deadline = time.monotonic() + self.sleep_dur
+        self.ticks = 0
+        self.missed = 0 # deadlines that didn't get a tick in their own period
+        self._lateness = np.zeros(window)
 
     def remaining(self):
         """
-        Return the time remaining for rate to sleep.
-        @return: time remaining
+        Return the time remaining until the next deadline.
+        @return: time remaining (negative if the deadline has passed)
         @rtype: float
         """
-        curr_time = time.time()
-        return self._remaining(curr_time)
+        return self.deadline - time.monotonic()
 
     async def sleep(self):
-
-        curr_time = time.time()
-        timeRemaining = self._remaining(curr_time)
-
+        """
+        Sleep until the next deadline.
+        @return: number of periods this tick accounts for, which is only ever
+            more than one under the 'coalesce' policy
+        @rtype: int
+        """
+        timeRemaining = self.remaining()
         if timeRemaining > 0.0:
             await asyncio.sleep(timeRemaining)
         else:
             await asyncio.sleep(0)
 
-        self.last_time = self.last_time + self.sleep_dur
+        now = time.monotonic()
+        late = now - self.deadline
+        self._lateness[self.ticks % self._lateness.size] = late
+        self.ticks += 1
+
+        behind = int(late // self.sleep_dur) if late > 0. else 0
+        if behind == 0:
+            self.deadline += self.sleep_dur
+            return 1
+        if self.policy == 'burst':
+            self.missed += 1
+            self.deadline += self.sleep_dur
+            return 1
+        self.missed += behind
+        self.deadline += (behind + 1) * self.sleep_dur
+        if self.policy == 'skip':
+            return 1
+        return behind + 1
 
-        if curr_time - self.last_time > self.sleep_dur * 2:
-            print("Time jumping forward detected")
-            self.last_time = curr_time
+    def stats(self):
+        """
+        Summarize how late ticks have been woken up, over the last `window`
+        ticks.
+        @return: lateness percentiles and max (in seconds), the number of
+            missed deadlines and the number of ticks so far
+        @rtype: dict
+        """
+        late = self._lateness[:min(self.ticks, self._lateness.size)]
+        if late.size == 0:
+            late = np.zeros(1)
+        p50, p95, p99 = np.percentile(late, [50, 95, 99])
+        return dict(
+            p50 = p50, p95 = p95, p99 = p99,
+            max_lateness = late.max(),
+            missed = self.missed,
+            ticks = self.ticks
+        )
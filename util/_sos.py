@@ -0,0 +1,52 @@
+from scipy.signal import sosfilt
+import numpy as np
+
+class SOSFilter(object):
+    """
+    Stateful IIR filter in second-order sections.
+
+    Cascaded biquads stay numerically stable at filter orders and sampling
+    rates where a single high-order `ba` polynomial does not. The filter state
+    is kept in `sosfilt`'s (transposed direct form II) layout, so single
+    samples and blocks of samples can be mixed freely and the output does not
+    depend on how the input was split up.
+    """
+    def __init__(self, sos: np.ndarray, shape: tuple = ()):
+        """
+        Constructor.
+        @param sos: second-order sections, (n_sections, 6)
+        @type  sos: np.ndarray
+        @param shape: shape of one sample, e.g. (n_channels,) or () for scalars
+        @type  shape: tuple
+        """
+        self.sos = np.asarray(sos, dtype = float)
+        self.zi = np.zeros((self.sos.shape[0], 2) + tuple(shape))
+        # plain floats are much quicker to do scalar arithmetic with
+        self._sections = [tuple(float(c) for c in s) for s in self.sos]
+
+    def filter_sample(self, x):
+        """
+        Filter one sample at a constant cost of a few multiply-adds per section.
+        @param x: a sample, matching `shape`
+        @type  x: float or np.ndarray
+        @return: the filtered sample
+        @rtype: float or np.ndarray
+        """
+        zi = self.zi
+        for i, (b0, b1, b2, _, a1, a2) in enumerate(self._sections):
+            y = b0 * x + zi[i, 0]
+            zi[i, 0] = b1 * x - a1 * y + zi[i, 1]
+            zi[i, 1] = b2 * x - a2 * y
+            x = y
+        return x
+
+    def filter_block(self, x: np.ndarray) -> np.ndarray:
+        """
+        Filter a block of samples along its first axis.
+        @param x: samples, (n_samples,) + `shape`
+        @type  x: np.ndarray
+        @return: the filtered samples
+        @rtype: np.ndarray
+        """
+        y, self.zi = sosfilt(self.sos, x, axis = 0, zi = self.zi)
+        return y
@@ -0,0 +1,72 @@
+'''
+Latency traces that travel with each sample through the processing chain.
+
+A trace holds the LSL local clock time at which the sample (or whatever was
+computed from it) entered and left each stage it passed through, with NaN for
+stages it hasn't been through, or that aren't in the graph. Each stage stamps
+a copy, so messages that share a trace (e.g. samples from one chunk) can't
+overwrite each other's stamps.
+'''
+from pylsl import local_clock
+import numpy as np
+
+# stages on the way from the amplifier to the screen, in order
+STAGES = ('source', 'decimator', 'filter', 'detector', 'control', 'display')
+SOURCE, DECIMATOR, FILTER, DETECTOR, CONTROL, DISPLAY = range(len(STAGES))
+
+def new_trace() -> np.ndarray:
+    '''
+    An empty trace, laid out as [stage0_in, stage0_out, stage1_in, ...].
+    '''
+    return np.full(2 * len(STAGES), np.nan)
+
+def ingress(trace: np.ndarray, stage: int) -> np.ndarray:
+    '''
+    Returns a copy of `trace` stamped with the time `stage` received it.
+    '''
+    trace = trace.copy()
+    trace[2 * stage] = local_clock()
+    return trace
+
+def egress(trace: np.ndarray, stage: int) -> np.ndarray:
+    '''
+    Returns a copy of `trace` stamped with the time `stage` passed it on.
+    '''
+    trace = trace.copy()
+    trace[2 * stage + 1] = local_clock()
+    return trace
+
+def latencies(traces: np.ndarray, timestamps: np.ndarray):
+    '''
+    Breaks a stack of traces down into where the time went.
+
+    Arguments
+    ---------
+    traces : np.ndarray, (n_traces, 2 * n_stages)
+    timestamps : np.ndarray, (n_traces,)
+        Acquisition time of the sample each trace belongs to.
+
+    Returns
+    -------
+    stage : np.ndarray, (n_traces, n_stages)
+        Time spent in each stage.
+    wait : np.ndarray, (n_traces, n_stages)
+        Time from the previous stage passing the sample on (or from its
+        acquisition, for the first stage) to each stage receiving it, i.e.
+        time spent in queues and inter-process transport.
+    total : np.ndarray, (n_traces,)
+        Time from acquisition to the last stage passing the sample on.
+    '''
+    traces = np.atleast_2d(traces)
+    ins, outs = traces[:, 0::2], traces[:, 1::2]
+    stage = outs - ins
+    # time each stage's input was handed over: the last stamped output before
+    # it, skipping stages the sample didn't go through
+    prev = np.concatenate((timestamps[:, None], outs[:, :-1]), axis = 1)
+    cols = np.where(np.isfinite(prev), np.arange(prev.shape[1]), 0)
+    cols = np.maximum.accumulate(cols, axis = 1)
+    prev = prev[np.arange(prev.shape[0])[:, None], cols]
+    wait = ins - prev
+    last = np.where(np.isfinite(outs), np.arange(outs.shape[1]), 0).max(axis = 1)
+    total = outs[np.arange(outs.shape[0]), last] - timestamps
+    return stage, wait, total
@@ -1,17 +1,22 @@
 from scipy.signal import butter
-from collections import deque
+from dataclasses import field
 import numpy as np
 import asyncio
 
-from typing import Deque
+from typing import List
 
-from ._messages import SampleMessage, FloatMessage
+from ._messages import SampleMessage, SampleChunkMessage, FloatMessage, LeadMessage
+from ._decimate import fill_nonfinite
+from ._leads import LeadSelector
+from ._sos import SOSFilter
+from ._trace import ingress, egress, FILTER
 import labgraph as lg
 
 class BandPassState(lg.State):
-    # data buffers
-    xs: Deque[float] = None
-    ys: Deque[float] = None
+    sos_filter: SOSFilter = None
+    last_x: np.ndarray = None # last finite input(s), to stand in for NaNs
+    selector: LeadSelector = None
+    noise_filter: SOSFilter = None # for the selector
 
 class BandPassConfig(lg.Config):
     # filter specifications
@@ -21,48 +26,119 @@ class BandPassConfig(lg.Config):
     order: int = 1
     # index from which to pull data from SampleMessage
     ch_idx: int = 0
+    # or, to filter several leads and pass on whichever is cleanest
+    channels: List[int] = field(default_factory = list)
+    # above which a lead's content counts against it as noise
+    noise_cutoff: float = 25.
     convert_microV_to_mV: bool = False
 
 class BandPass(lg.Node):
     '''
     an online butterworth filter
+
+    If more than one channel is configured, all of them are filtered together
+    and a LeadSelector decides which one is published as the ECG.
     '''
     INPUT = lg.Topic(SampleMessage)
+    CHUNK_INPUT = lg.Topic(SampleChunkMessage)
     OUTPUT = lg.Topic(FloatMessage)
+    LEAD_OUTPUT = lg.Topic(LeadMessage)
 
     state: BandPassState
     config: BandPassConfig
 
     def setup(self) -> None:
-        b, a = butter(
+        sos = butter(
             self.config.order,
             [self.config.low_cutoff, self.config.high_cutoff],
             btype = 'bandpass',
-            output = 'ba',
+            output = 'sos',
             fs = self.config.sfreq
             )
-        self.state.xs = deque([0] * len(b), maxlen = len(b))
-        self.state.ys = deque([0] * (len(a) - 1), maxlen = len(a) - 1)
-        self.b = b
-        self.a = a
+        self._channels = list(self.config.channels) or [self.config.ch_idx]
+        n = len(self._channels)
+        self._multi = n > 1
+        if self._multi:
+            self.state.sos_filter = SOSFilter(sos, (n,))
+            self.state.last_x = np.zeros(n)
+            self.state.selector = LeadSelector(n, self.config.sfreq)
+            # out-of-band noise, for scoring the leads
+            self.state.noise_filter = SOSFilter(butter(
+                2, self.config.noise_cutoff,
+                btype = 'highpass',
+                output = 'sos',
+                fs = self.config.sfreq
+                ), (n,))
+        else: # keep the single lead on the quicker scalar path
+            self._channels = self._channels[0]
+            self.state.sos_filter = SOSFilter(sos)
+            self.state.last_x = 0.
+
+    def _lead_message(self, t: float) -> LeadMessage:
+        selector = self.state.selector
+        return LeadMessage(
+            timestamp = t,
+            lead = self._channels[selector.lead],
+            scores = selector.scores
+            )
 
     @lg.subscriber(INPUT)
     @lg.publisher(OUTPUT)
+    @lg.publisher(LEAD_OUTPUT)
     async def filter(self, message: SampleMessage) -> lg.AsyncPublisher:
         '''
         Receives a new observation of raw time series, and yields an
         observation of the bandpass filtered time series.
         '''
         t = message.timestamp
-        x = message.data[self.config.ch_idx] # pull out data channel
-        if not np.isfinite(x):
-            x = self.state.xs[0] # handle NaNs
+        trace = ingress(message.trace, FILTER)
+        x = message.data[self._channels] # pull out data channel(s)
+        if self._multi:
+            finite = np.isfinite(x)
+            if not finite.all():
+                x = np.where(finite, x, self.state.last_x) # handle NaNs
+        else:
+            x = float(x)
+            if not np.isfinite(x):
+                x = self.state.last_x # handle NaNs
+        self.state.last_x = x
+        if self.config.convert_microV_to_mV:
+            x = x * 1e3
+        y = self.state.sos_filter.filter_sample(x)
+        if self._multi:
+            hf = self.state.noise_filter.filter_sample(x)
+            if self.state.selector.update(y, hf):
+                yield self.LEAD_OUTPUT, self._lead_message(t)
+            y = y[self.state.selector.lead]
+        yield self.OUTPUT, FloatMessage(
+            timestamp = t, data = y, trace = egress(trace, FILTER)
+            )
+
+    @lg.subscriber(CHUNK_INPUT)
+    @lg.publisher(OUTPUT)
+    @lg.publisher(LEAD_OUTPUT)
+    async def filter_chunk(self, message: SampleChunkMessage) -> lg.AsyncPublisher:
+        '''
+        Receives a block of raw time series, filters it in one go, and yields
+        the filtered observations one at a time.
+        '''
+        trace = ingress(message.trace, FILTER)
+        x = message.data[:, np.atleast_1d(self._channels)]
+        x = fill_nonfinite(x, np.atleast_1d(self.state.last_x))
+        if self._multi:
+            self.state.last_x = x[-1]
+        else:
+            x = x[:, 0]
+            self.state.last_x = float(x[-1])
         if self.config.convert_microV_to_mV:
-            x *= 1e3
-        a = self.a
-        b = self.b
-        self.state.xs.appendleft(x)
-        y = np.dot(b, self.state.xs) - np.dot(a[1:], self.state.ys)
-        y = y / a[0]
-        self.state.ys.appendleft(y)
-        yield self.OUTPUT, FloatMessage(timestamp = t, data = y)
+            x = x * 1e3
+        ys = self.state.sos_filter.filter_block(x)
+        if self._multi:
+            hfs = self.state.noise_filter.filter_block(x)
+            if self.state.selector.update_block(ys, hfs):
+                yield self.LEAD_OUTPUT, self._lead_message(message.timestamp)
+            ys = ys[:, self.state.selector.lead]
+        for t, y in zip(message.timestamps, ys):
+            yield self.OUTPUT, FloatMessage(
+                timestamp = t, data = y, trace = egress(trace, FILTER)
+                )
@@ -0,0 +1,37 @@
+'''
+Delays that the experiment compensates for, as measured by calibrate.py and
+read by graph.py and bidsify.py, so they can be re-measured whenever the
+hardware or the layout of the graph changes.
+'''
+import json
+import os
+
+CALIBRATION_FILE = 'calibration.json'
+
+# used for anything the file doesn't have, or if there isn't one
+DEFAULTS = dict(
+    # amplifier delay, which calibrate.py can't measure over a local LSL
+    # stream, so it's carried over from the file or set by hand (ours is the
+    # ~35 ms the TMSi SAGA reports as its 'offset_mean')
+    hardware_delay = .035,
+    # time from an R-peak to its detection, in sample time, not counting the
+    # decimator's delay (see ControlConfig.detection_lag)
+    detection_lag = 0.,
+)
+
+def load_calibration(path: str = CALIBRATION_FILE) -> dict:
+    '''
+    The calibration in `path`, filled in from DEFAULTS.
+    '''
+    calibration = dict(DEFAULTS)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            calibration.update(json.load(f))
+    return calibration
+
+def save_calibration(calibration: dict, path: str = CALIBRATION_FILE) -> None:
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(calibration, f, indent = 4)
+    os.replace(tmp_path, path) # so a crash never leaves half a file
@@ -1,26 +1,68 @@
-from scipy.stats import norm
 from collections import deque
 import numpy as np
 import asyncio
+import math
 
 from typing import Deque
 from pylsl import local_clock
 
 from ._messages import DisplayMessage, FloatMessage
+from ._ibi import IBIPredictor
+from ._trace import ingress, egress, CONTROL
 import labgraph as lg
 
+def size_profile(t, phase, scale):
+    '''
+    Stimulus size as a function of time since R-peak: a gaussian bump that
+    peaks at 1 at `phase` seconds after the R-peak, with standard deviation
+    `scale`. This is norm.pdf(t, phase, scale) / norm.pdf(phase, phase, scale)
+    in closed form, and works elementwise on arrays of times.
+    '''
+    z = (np.asarray(t, dtype = float) - phase) / scale
+    return np.exp(-.5 * z * z)
+
+def stimulus_size(t, phase, gain, ibi = math.nan):
+    '''
+    Scalar size_profile, for `t` seconds after the last R-peak, with the
+    gaussian's exponent per squared second from `phase` precomputed as
+    `gain` = -.5 / scale**2. If the interval `ibi` to the next R-peak is
+    known (not NaN), the window around the next beat counts too, so it can
+    open before that beat is detected.
+    '''
+    d = t - phase
+    sz = math.exp(gain * d * d)
+    if ibi == ibi:
+        d -= ibi
+        sz = max(sz, math.exp(gain * d * d))
+    return sz
+
 class ControlState(lg.State):
     # data buffer
     last_t_since: float = 0.
     last_ibi: float = 0.
+    last_rpeak_t: float = None # timestamp of last detected R-peak
+    predictor: IBIPredictor = None
 
 class ControlConfig(lg.Config):
     systole_lag: float = .210 # seconds after R-peak to define as systole
     scale: float = 0.25/4 # roughly 1/4 intended stimulus duration
+    # place stimuli relative to predicted R-peaks when the predictor is
+    # at least `min_confidence` sure of the next one
+    predictive: bool = False
+    min_confidence: float = .5
+    ibi_history: int = 8 # recent inter-beat intervals to predict from
+    # median delay from R-peak to detection (see benchmark.py qrs)
+    detection_lag: float = 0.
 
 class Control(lg.Node):
     '''
     controls state of rivalry stimuli based on time since last detected R-peak
+
+    In predictive mode, R-peaks are taken to have happened `detection_lag`
+    before they were detected, and the stimulus windows for the next beat
+    are opened ahead of time from the predicted inter-beat interval, instead
+    of only once the detector has caught up with that beat. When the
+    prediction isn't confident enough, sizes are purely reactive.
     '''
     INPUT = lg.Topic(FloatMessage)
     OUTPUT = lg.Topic(DisplayMessage)
@@ -28,14 +70,16 @@ class Control(lg.Node):
     state: ControlState
     config: ControlConfig
 
+    def setup(self) -> None:
+        # exponent of the normalized gaussian, per squared second from phase
+        self._gain = -.5 / self.config.scale ** 2
+        self.state.predictor = IBIPredictor(self.config.ibi_history)
+
     def size_func(self, t, phase):
         '''
         determines stimulus size as a function of time since R-peak
         '''
-        m = phase # in ms relative to R-peak
-        w = self.config.scale
-        sz = norm.pdf(t, loc = m, scale = w) / norm.pdf(m, loc = m, scale = w)
-        return sz
+        return stimulus_size(t, phase, self._gain)
 
     @lg.subscriber(INPUT)
     @lg.publisher(OUTPUT)
@@ -44,19 +88,39 @@ class Control(lg.Node):
         Receives a new observation of raw time series, and yields an
         observation of the bandpass filtered time series.
         '''
+        trace = ingress(message.trace, CONTROL)
         t = message.timestamp
         time_since_rpeak = message.data
         if time_since_rpeak == 0.:
             self.state.last_ibi = self.state.last_t_since
+            if self.state.last_rpeak_t is not None:
+                self.state.predictor.update(t - self.state.last_rpeak_t)
+            self.state.last_rpeak_t = t
         self.state.last_t_since = time_since_rpeak
 
         # compute sizes of syncronous and asyncronous stimulus
-        sz_sync = self.size_func(time_since_rpeak, self.config.systole_lag)
-        async_lag = self.config.systole_lag + (self.state.last_ibi / 2)
-        sz_async = self.size_func(time_since_rpeak, async_lag)
+        predictor = self.state.predictor
+        sync_lag = self.config.systole_lag
+        if self.config.predictive and \
+                predictor.confidence >= self.config.min_confidence:
+            # time since the R-peak itself, rather than its detection
+            t_since = time_since_rpeak + self.config.detection_lag
+            ibi = predictor.prediction
+            async_lag = sync_lag + (ibi / 2)
+        else:
+            t_since = time_since_rpeak
+            ibi = math.nan # no next-beat window in reactive mode
+            async_lag = sync_lag + (self.state.last_ibi / 2)
+        sz_sync = stimulus_size(t_since, sync_lag, self._gain, ibi)
+        sz_async = stimulus_size(t_since, async_lag, self._gain, ibi)
 
         yield self.OUTPUT, DisplayMessage(
             timestamp = t,
             sz_sync = sz_sync, sz_async = sz_async,
-            process_t = local_clock()
+            process_t = local_clock(),
+            trace = egress(trace, CONTROL),
+            # so the display can work out sizes at flip time
+            t_since = t_since, ibi = ibi,
+            sync_lag = sync_lag, async_lag = async_lag,
+            scale = self.config.scale
             )
@@ -0,0 +1,82 @@
+import numpy as np
+
+from ._messages import SampleMessage, SampleChunkMessage
+from ._decimate import PolyphaseDecimator
+from ._trace import ingress, egress, DECIMATOR
+import labgraph as lg
+
+class DecimatorState(lg.State):
+    decimator: PolyphaseDecimator = None
+
+class DecimatorConfig(lg.Config):
+    factor: int = 5
+    sfreq: float = 500. # input sampling rate
+    # 21 taps at 500 Hz puts the stopband just above 80 Hz, so nothing aliases
+    # into the ECG band, for a group delay of only 20 ms
+    numtaps: int = 21
+    cutoff: float = .8 # as a fraction of the output Nyquist rate
+
+def decimator_delay(config: DecimatorConfig) -> float:
+    '''
+    The delay (in seconds) that the anti-aliasing filter adds to the signal.
+    '''
+    if config.factor == 1:
+        return 0.
+    return (config.numtaps - 1) / 2. / config.sfreq
+
+class Decimator(lg.Node):
+    '''
+    Low-pass filters and downsamples raw samples by an integer factor, so we
+    don't alias whatever is above the new Nyquist rate into the ECG band.
+
+    Accepts single samples or blocks, and publishes the decimated samples one
+    at a time with the timestamp of the input sample each one lines up with.
+    '''
+    INPUT = lg.Topic(SampleMessage)
+    CHUNK_INPUT = lg.Topic(SampleChunkMessage)
+    OUTPUT = lg.Topic(SampleMessage)
+
+    state: DecimatorState
+    config: DecimatorConfig
+
+    def setup(self) -> None:
+        self.state.decimator = PolyphaseDecimator(
+            self.config.factor,
+            self.config.numtaps,
+            self.config.sfreq,
+            self.config.cutoff
+            )
+
+    @property
+    def delay(self):
+        return self.state.decimator.delay
+
+    async def _decimate(self, x, ts, trace) -> lg.AsyncPublisher:
+        trace = ingress(trace, DECIMATOR)
+        y, idx = self.state.decimator.filter(x)
+        for sample, t in zip(y, ts[idx]):
+            yield self.OUTPUT, SampleMessage(
+                timestamp = t, data = sample, trace = egress(trace, DECIMATOR)
+                )
+
+    @lg.subscriber(CHUNK_INPUT)
+    @lg.publisher(OUTPUT)
+    async def decimate_chunk(self, message: SampleChunkMessage) -> lg.AsyncPublisher:
+        '''
+        Receives a block of raw samples, and yields the decimated samples.
+        '''
+        async for topic, msg in self._decimate(
+                message.data, message.timestamps, message.trace):
+            yield topic, msg
+
+    @lg.subscriber(INPUT)
+    @lg.publisher(OUTPUT)
+    async def decimate(self, message: SampleMessage) -> lg.AsyncPublisher:
+        '''
+        Receives a single raw sample, and yields a decimated sample every
+        `factor` calls.
+        '''
+        x = message.data[None, :]
+        ts = np.array([message.timestamp])
+        async for topic, msg in self._decimate(x, ts, message.trace):
+            yield topic, msg
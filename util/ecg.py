@@ -1,12 +1,44 @@
 import neurokit2 as nk
 import numpy as np
+import hashlib
 import asyncio
+import json
+import os
 from pylsl import local_clock
 
-from ._messages import SampleMessage
+from ._messages import SampleMessage, SampleChunkMessage, RateStatsMessage
 from ._rate import Rate
+from ._trace import new_trace, ingress, egress, SOURCE
 import labgraph as lg
 
+def simulate_ecg(duration: float, sfreq: float, heart_rate: float,
+                 heart_rate_std: float, noise: float, seed: int,
+                 cache_dir: str) -> np.ndarray:
+    '''
+    Simulates an ECG recording with neurokit2, or loads it from `cache_dir`
+    if one with the same parameters has been simulated before. The recording
+    is returned as a read-only memory-mapped array, so long recordings are
+    cheap to load and to share between processes.
+    '''
+    params = dict(
+        duration = duration,
+        sampling_rate = int(sfreq),
+        heart_rate = heart_rate,
+        heart_rate_std = heart_rate_std,
+        noise = noise,
+        random_state = seed
+    )
+    key = json.dumps(params, sort_keys = True).encode()
+    key = hashlib.sha1(key).hexdigest()[:16]
+    fpath = os.path.join(cache_dir, 'ecg_%s.npy'%key)
+    if not os.path.exists(fpath):
+        ecg = nk.ecg_simulate(**params)
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp_fpath = fpath.replace('.npy', '.tmp.npy')
+        np.save(tmp_fpath, np.asarray(ecg, dtype = float))
+        os.replace(tmp_fpath, fpath) # so a crash never leaves half a file
+    return np.load(fpath, mmap_mode = 'r')
+
 class ECGState(lg.State):
     idx: int = 0
     ecg: np.array = None
@@ -14,21 +46,42 @@ class ECGState(lg.State):
 class ECGConfig(lg.Config):
     sfreq: float = 100.
     heart_rate: float = 60.
+    heart_rate_std: float = 1. # heart rate variability, in beats per minute
+    noise: float = .01
+    duration: float = 300. # seconds simulated before the recording loops
+    seed: int = 0
+    cache_dir: str = '.cache'
+    # publish blocks of `chunk_size` samples on CHUNK_OUTPUT instead of
+    # single samples on OUTPUT
+    chunk: bool = False
+    chunk_size: int = 10
+    # multiple of real time, or 0 for as fast as possible (in which case
+    # samples are stamped as if acquired in real time, so timestamps run
+    # ahead of the clock and latency stats mean nothing)
+    speed: float = 1.
+    catch_up: str = 'coalesce' # what to do when we fall behind (see Rate)
+    stats_interval: float = 1. # seconds between STATS_OUTPUT messages
 
 class ECGSimulator(lg.Node):
     '''
     Simulates a live ECG recording timestamped with the LSL local clock.
     '''
     OUTPUT = lg.Topic(SampleMessage)
+    CHUNK_OUTPUT = lg.Topic(SampleChunkMessage)
+    STATS_OUTPUT = lg.Topic(RateStatsMessage)
 
     state: ECGState
     config: ECGConfig
 
     def setup(self) -> None:
-        self.state.ecg = nk.ecg_simulate(
-            duration = int(5),
-            sampling_rate = int(self.config.sfreq),
-            heart_rate = int(self.config.heart_rate)
+        self.state.ecg = simulate_ecg(
+            duration = self.config.duration,
+            sfreq = self.config.sfreq,
+            heart_rate = self.config.heart_rate,
+            heart_rate_std = self.config.heart_rate_std,
+            noise = self.config.noise,
+            seed = self.config.seed,
+            cache_dir = self.config.cache_dir
             )
         self._shutdown = False
 
@@ -36,16 +89,52 @@ class ECGSimulator(lg.Node):
         #self._shutdown = True
         return
 
-    def get_ecg(self, idx):
-        i = idx % (self.state.ecg.shape[0] - 1)
-        return np.array([self.state.ecg[i]])
+    def get_ecg(self, idx, n = 1):
+        '''
+        Returns n samples starting at idx as an (n, 1) array, looping back to
+        the start of the recording when we run off the end.
+        '''
+        i = (idx + np.arange(n)) % self.state.ecg.shape[0]
+        return self.state.ecg[i][:, None]
 
     @lg.publisher(OUTPUT)
+    @lg.publisher(CHUNK_OUTPUT)
+    @lg.publisher(STATS_OUTPUT)
     async def simulate(self) -> lg.AsyncPublisher:
-        rate = Rate(self.config.sfreq)
+        n = self.config.chunk_size if self.config.chunk else 1
+        speed = self.config.speed
+        # samples are stamped with when they're due on the real-time schedule
+        period = 1. / (self.config.sfreq * (speed if speed > 0 else 1.))
+        if speed > 0:
+            rate = Rate(self.config.sfreq * speed / n, self.config.catch_up)
+        else:
+            rate = None
+        t0 = local_clock()
+        t_stats = t0 + self.config.stats_interval
+        ticks = 1
         while not self._shutdown:
-            self.state.idx += 1
-            ecg = self.get_ecg(self.state.idx)
-            t = local_clock()
-            yield self.OUTPUT, SampleMessage(timestamp = t, data = ecg)
-            await rate.sleep()
+            m = n * ticks # a coalesced tick makes up for the ones it replaced
+            ecg = self.get_ecg(self.state.idx, m)
+            ts = t0 + (self.state.idx + np.arange(m)) * period
+            self.state.idx += m
+            trace = ingress(new_trace(), SOURCE)
+            if self.config.chunk:
+                yield self.CHUNK_OUTPUT, SampleChunkMessage(
+                    timestamp = ts[-1], data = ecg, timestamps = ts,
+                    trace = egress(trace, SOURCE)
+                    )
+            else:
+                for x, t in zip(ecg, ts):
+                    yield self.OUTPUT, SampleMessage(
+                        timestamp = t, data = x, trace = egress(trace, SOURCE)
+                        )
+            if rate is None:
+                await asyncio.sleep(0) # let the rest of the loop run
+                continue
+            now = local_clock()
+            if now >= t_stats:
+                t_stats = now + self.config.stats_interval
+                yield self.STATS_OUTPUT, RateStatsMessage(
+                    timestamp = now, **rate.stats()
+                    )
+            ticks = await rate.sleep()
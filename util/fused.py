@@ -0,0 +1,75 @@
+from ._messages import (
+    SampleMessage, SampleChunkMessage, FloatMessage, LeadMessage, DisplayMessage
+)
+from .bandpass import BandPass, BandPassConfig
+from .qrs import QRSDetector, QRSDetectorConfig
+from .control import Control, ControlConfig
+import labgraph as lg
+
+class FusedPipelineConfig(lg.Config):
+    filter: BandPassConfig
+    detector: QRSDetectorConfig
+    control: ControlConfig
+
+class FusedPipeline(lg.Node):
+    '''
+    Runs the BandPass -> QRSDetector -> Control chain inside one node, so each
+    sample is handed from stage to stage by a direct call instead of being
+    serialized and sent to another process. Every stage's output is still
+    published on its own topic, so the same things can be logged as when the
+    stages run as separate nodes.
+    '''
+    INPUT = lg.Topic(SampleMessage)
+    CHUNK_INPUT = lg.Topic(SampleChunkMessage)
+    FILTER_OUTPUT = lg.Topic(FloatMessage)
+    LEAD_OUTPUT = lg.Topic(LeadMessage)
+    DETECTOR_OUTPUT = lg.Topic(FloatMessage)
+    OUTPUT = lg.Topic(DisplayMessage)
+
+    config: FusedPipelineConfig
+
+    def setup(self) -> None:
+        self._filter = BandPass(config = self.config.filter)
+        self._detector = QRSDetector(config = self.config.detector)
+        self._control = Control(config = self.config.control)
+        self._stages = (self._filter, self._detector, self._control)
+        for stage in self._stages:
+            stage.setup()
+
+    def cleanup(self) -> None:
+        for stage in self._stages:
+            stage.cleanup()
+
+    async def _forward(self, filtered) -> lg.AsyncPublisher:
+        '''
+        Passes the filter's outputs on down the chain, re-publishing each
+        stage's output on the matching topic.
+        '''
+        async for _, message in filtered:
+            if isinstance(message, LeadMessage):
+                self._detector.relearn()
+                yield self.LEAD_OUTPUT, message
+                continue
+            yield self.FILTER_OUTPUT, message
+            async for _, t_since in self._detector.process(message):
+                yield self.DETECTOR_OUTPUT, t_since
+                async for _, sizes in self._control.map_to_size(t_since):
+                    yield self.OUTPUT, sizes
+
+    @lg.subscriber(INPUT)
+    @lg.publisher(FILTER_OUTPUT)
+    @lg.publisher(LEAD_OUTPUT)
+    @lg.publisher(DETECTOR_OUTPUT)
+    @lg.publisher(OUTPUT)
+    async def process(self, message: SampleMessage) -> lg.AsyncPublisher:
+        async for out in self._forward(self._filter.filter(message)):
+            yield out
+
+    @lg.subscriber(CHUNK_INPUT)
+    @lg.publisher(FILTER_OUTPUT)
+    @lg.publisher(LEAD_OUTPUT)
+    @lg.publisher(DETECTOR_OUTPUT)
+    @lg.publisher(OUTPUT)
+    async def process_chunk(self, message: SampleChunkMessage) -> lg.AsyncPublisher:
+        async for out in self._forward(self._filter.filter_chunk(message)):
+            yield out
@@ -0,0 +1,60 @@
+from collections import deque
+from pylsl import local_clock
+import numpy as np
+import warnings
+import asyncio
+
+from ._messages import TraceMessage, LatencyMessage
+from ._trace import latencies
+import labgraph as lg
+
+class LatencyMonitorConfig(lg.Config):
+    window: int = 1000 # most recent traces to summarize
+    interval: float = 1. # seconds between OUTPUT messages
+
+class LatencyMonitor(lg.Node):
+    '''
+    Summarizes the latency traces of samples that have reached the display
+    as rolling percentiles of the time spent in, and between, each stage of
+    the pipeline, and from acquisition to the screen.
+    '''
+    INPUT = lg.Topic(TraceMessage)
+    OUTPUT = lg.Topic(LatencyMessage)
+
+    config: LatencyMonitorConfig
+
+    def setup(self) -> None:
+        self._timestamps = deque(maxlen = self.config.window)
+        self._traces = deque(maxlen = self.config.window)
+        self._shutdown = False
+
+    def cleanup(self) -> None:
+        self._shutdown = True
+
+    @lg.subscriber(INPUT)
+    def collect(self, message: TraceMessage) -> None:
+        self._timestamps.append(message.timestamp)
+        self._traces.append(message.trace)
+
+    @lg.publisher(OUTPUT)
+    async def publish(self) -> lg.AsyncPublisher:
+        while not self._shutdown:
+            await asyncio.sleep(self.config.interval)
+            if not self._traces:
+                continue
+            stage, wait, total = latencies(
+                np.stack(self._traces), np.array(self._timestamps)
+                )
+            q = [50, 95, 99]
+            with warnings.catch_warnings(): # stages not in the graph are NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                stage = np.nanpercentile(stage, q, axis = 0) # (3, n_stages)
+                wait = np.nanpercentile(wait, q, axis = 0)
+                total = np.nanpercentile(total, q)
+            yield self.OUTPUT, LatencyMessage(
+                timestamp = local_clock(),
+                n = len(self._traces),
+                stage_p50 = stage[0], stage_p95 = stage[1], stage_p99 = stage[2],
+                wait_p50 = wait[0], wait_p95 = wait[1], wait_p99 = wait[2],
+                total = total
+                )
@@ -0,0 +1,55 @@
+'''
+Helpers for reading the HDF5 logs written by LabGraph's logger, in which
+each topic is a compound dataset with one field per message field.
+'''
+import numpy as np
+
+def column(records: np.ndarray, name: str) -> np.ndarray:
+    '''
+    Pull a field out of a structured array of logged messages. Array fields
+    are logged as variable length records, which come back as an object array
+    of arrays, so these are stacked into one (n_records, ...) array.
+    '''
+    col = records[name]
+    if col.dtype == object and col.size and isinstance(col[0], np.ndarray):
+        return np.stack(col)
+    return col
+
+def iter_records(dataset, read_size: int = 10000, start: int = 0, stop: int = None):
+    '''
+    Iterate over a logged topic `read_size` records at a time, so only one
+    block is ever held in memory.
+
+    Arguments
+    ---------
+    dataset : h5py.Dataset
+        A topic from the log, e.g. f['ecg_raw'].
+    read_size : int
+        How many records to read from disk at once.
+    start, stop : int
+        Range of records to read (default is all of them).
+    '''
+    stop = dataset.shape[0] if stop is None else min(stop, dataset.shape[0])
+    for i in range(start, stop, read_size):
+        yield dataset[i:min(i + read_size, stop)]
+
+def read_topic(f, name: str) -> np.ndarray:
+    '''
+    Read a whole logged topic from disk in one go, as a structured array
+    from which `column` pulls fields by name without copying them.
+    '''
+    return f[name][()]
+
+def decode(col: np.ndarray) -> np.ndarray:
+    '''
+    A logged string field (which may come back as bytes) as an array of str,
+    decoded all at once.
+    '''
+    if col.dtype.kind == 'U':
+        return col
+    if col.dtype.kind == 'S':
+        return np.char.decode(col, 'utf-8')
+    # variable length strings come back as an object array
+    if col.size and isinstance(col[0], str):
+        return col.astype(str)
+    return np.char.decode(col.astype(bytes), 'utf-8')
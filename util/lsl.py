@@ -1,39 +1,216 @@
-from pylsl import StreamInlet, resolve_stream
+from pylsl import StreamInlet, resolve_stream, local_clock
+from dataclasses import field
+from functools import partial
+from typing import List
 import numpy as np
+import threading
 import asyncio
+import time
 
-from ._messages import SampleMessage
-from ._rate import Rate
+from ._messages import (
+    SampleMessage,
+    SampleChunkMessage,
+    ChannelChunkMessage,
+    ClockSyncMessage,
+    PollerStatsMessage
+)
+from ._clock import ClockSync
+from ._trace import new_trace, ingress, egress, SOURCE
 import labgraph as lg
 
 
 class LSLPollerConfig(lg.Config):
     type: str = 'EEG'
+    # if set, the stream to read, instead of the first one of type `type`
+    source_id: str = ''
     sfreq: float = 500.
     downsample: int = 1
+    # pull everything available with `pull_chunk` and publish it as a block
+    # on CHUNK_OUTPUT instead of publishing single samples on OUTPUT
+    chunk: bool = False
+    chunk_rate: float = 50. # how often to drain the inlet in chunk mode
+    max_chunk: int = 1024 # most samples to pull at once
+    clock_sync_interval: float = 5. # seconds between clock offset estimates
+    timeout: float = .5 # longest the reader thread blocks before rechecking
+    stats_interval: float = 1. # seconds between STATS_OUTPUT messages
+    # in chunk mode, channels to also publish on LOG_OUTPUT, for logging
+    log_channels: List[int] = field(default_factory = list)
 
 class LSLPollerNode(lg.Node):
+    '''
+    Reads samples from an LSL stream.
 
+    Pulling from the inlet blocks, so it is done in a dedicated reader thread
+    that hands samples to the node's event loop through an asyncio queue; if
+    the amplifier stalls, only that thread waits.
+
+    Samples' traces are stamped on arrival in the reader thread and when
+    they're published, and their timestamps are mapped onto the local clock,
+    so the trace also shows the delay between acquisition and arrival.
+    '''
     OUTPUT = lg.Topic(SampleMessage)
+    CHUNK_OUTPUT = lg.Topic(SampleChunkMessage)
+    LOG_OUTPUT = lg.Topic(ChannelChunkMessage)
+    CLOCK_OUTPUT = lg.Topic(ClockSyncMessage)
+    STATS_OUTPUT = lg.Topic(PollerStatsMessage)
     config: LSLPollerConfig
 
     def setup(self) -> None:
-        self._shutdown = False
-
-    def setup(self) -> None:
-        self.streams = resolve_stream('type', self.config.type)
+        self._shutdown = threading.Event()
+        self._reader = None
+        self._queue = None
+        # arrivals are counted in the reader thread and reported from the
+        # event loop, so the counters below are only touched under this
+        self._lock = threading.Lock()
+        self._last_arrival = None
+        self._stall = 0. # longest gap between arrivals since last report
+        self._n_samples = 0 # samples pulled since last report
+        self._max_depth = 0 # deepest the queue got since last report
+        if self.config.source_id:
+            self.streams = resolve_stream('source_id', self.config.source_id)
+        else:
+            self.streams = resolve_stream('type', self.config.type)
         self.inlet = StreamInlet(self.streams[0])
+        # keeps time_correction() queries off the sample loop
+        self.clock = ClockSync(self.inlet, self.config.clock_sync_interval)
+        self.clock.start()
+
+    def cleanup(self) -> None:
+        self._shutdown.set()
+        self.clock.stop()
+        if self._reader is not None:
+            self._reader.join()
+
+    def _arrived(self, n: int) -> None:
+        now = time.monotonic()
+        with self._lock:
+            if self._last_arrival is not None:
+                self._stall = max(self._stall, now - self._last_arrival)
+            self._last_arrival = now
+            self._n_samples += n
+
+    def _read_samples(self, put) -> None:
+        count = 0
+        while not self._shutdown.is_set():
+            sample, t = self.inlet.pull_sample(timeout = self.config.timeout)
+            if t is None:
+                continue
+            self._arrived(1)
+            t = self.clock(t) # map timestamp to local clock
+            count += 1
+            if count % self.config.downsample == 0:
+                x = np.array(sample)
+                put((self.OUTPUT, SampleMessage, dict(
+                    timestamp = t, data = x,
+                    trace = ingress(new_trace(), SOURCE)
+                    )))
+
+    def _read_chunks(self, put) -> None:
+        '''
+        Drains the inlet at `chunk_rate` and hands over whatever has arrived
+        since the last pull as one block, so the per-sample cost is a slice
+        of one array rather than a loop iteration and a message.
+        '''
+        period = 1. / self.config.chunk_rate
+        count = 0
+        while not self._shutdown.is_set():
+            samples, ts = self.inlet.pull_chunk(
+                timeout = 0.,
+                max_samples = self.config.max_chunk
+                )
+            if not ts: # wait for data rather than spinning
+                sample, t = self.inlet.pull_sample(timeout = self.config.timeout)
+                if t is None:
+                    continue
+                samples, ts = [sample], [t]
+            self._arrived(len(ts))
+            ts = self.clock(np.array(ts)) # map timestamps to local clock
+            x = np.array(samples, dtype = float)
+            # keep every `downsample`-th sample, counting across chunks
+            ds = self.config.downsample
+            keep = slice((ds - 1 - count) % ds, None, ds)
+            count += ts.size
+            x, ts = x[keep], ts[keep]
+            if ts.size:
+                put((self.CHUNK_OUTPUT, SampleChunkMessage, dict(
+                    timestamp = ts[-1], data = x, timestamps = ts,
+                    trace = ingress(new_trace(), SOURCE)
+                    )))
+                if self.config.log_channels:
+                    chans = self.config.log_channels
+                    put((self.LOG_OUTPUT, ChannelChunkMessage, dict(
+                        timestamp = ts[-1], timestamps = ts,
+                        channels = np.array(chans, dtype = float),
+                        data = x[:, chans].T.ravel() # channel by channel
+                        )))
+            if len(samples) < self.config.max_chunk:
+                self._shutdown.wait(period) # inlet is drained
+
+    def _read(self, put) -> None:
+        try:
+            if self.config.chunk:
+                self._read_chunks(put)
+            else:
+                self._read_samples(put)
+        except RuntimeError: # event loop closed under us at shutdown
+            return
 
     @lg.publisher(OUTPUT)
+    @lg.publisher(CHUNK_OUTPUT)
+    @lg.publisher(LOG_OUTPUT)
     async def lsl_subscriber(self) -> lg.AsyncPublisher:
-        rate = Rate(self.config.sfreq)
-        count = 0
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_event_loop()
+        put = partial(loop.call_soon_threadsafe, self._queue.put_nowait)
+        self._reader = threading.Thread(
+            target = self._read, args = (put,), daemon = True
+            )
+        self._reader.start()
         while True:
-            sample, t = self.inlet.pull_sample()
-            t += self.inlet.time_correction() # map timestamp to local clock
-            if t is not None:
-                count += 1
-                x = np.array(sample)
-                if count % self.config.downsample == 0:
-                    yield self.OUTPUT, SampleMessage(timestamp = t, data = x)
-                await rate.sleep()
+            # messages are built here rather than in the reader thread, so
+            # their traces include the time spent in the queue
+            topic, message_type, fields = await self._queue.get()
+            self._max_depth = max(self._max_depth, self._queue.qsize())
+            if 'trace' in fields:
+                fields['trace'] = egress(fields['trace'], SOURCE)
+            yield topic, message_type(**fields)
+
+    @lg.publisher(STATS_OUTPUT)
+    async def publish_stats(self) -> lg.AsyncPublisher:
+        '''
+        Reports how long the stream went without data and how far the
+        publisher fell behind the reader thread.
+        '''
+        while True:
+            await asyncio.sleep(self.config.stats_interval)
+            depth = self._queue.qsize() if self._queue is not None else 0
+            with self._lock: # take this period's counts and start the next
+                stall, self._stall = self._stall, 0.
+                n_samples, self._n_samples = self._n_samples, 0
+                last_arrival = self._last_arrival
+            if last_arrival is not None: # include a stall still going on
+                stall = max(stall, time.monotonic() - last_arrival)
+            yield self.STATS_OUTPUT, PollerStatsMessage(
+                timestamp = local_clock(),
+                stall_time = stall,
+                queue_depth = depth,
+                max_queue_depth = max(self._max_depth, depth),
+                n_samples = n_samples
+                )
+            self._max_depth = 0
+
+    @lg.publisher(CLOCK_OUTPUT)
+    async def publish_clock(self) -> lg.AsyncPublisher:
+        '''
+        Publishes the clock model whenever it is refit, for the logs.
+        '''
+        n_updates = 0
+        while True:
+            if self.clock.n_updates != n_updates:
+                n_updates = self.clock.n_updates
+                t0, offset, drift = self.clock.params
+                yield self.CLOCK_OUTPUT, ClockSyncMessage(
+                    timestamp = local_clock(),
+                    t0 = t0, offset = offset, drift = drift
+                    )
+            await asyncio.sleep(self.config.clock_sync_interval)
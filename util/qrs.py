@@ -1,15 +1,13 @@
-import numpy as np
-from collections import deque
-import asyncio
-from typing import Deque
 from scipy.signal import find_peaks
 
-from ._messages import FloatMessage
+from ._messages import FloatMessage, LeadMessage
+from ._integrator import MovingIntegral
+from ._trace import ingress, egress, DETECTOR
 import labgraph as lg
 
 
 class QRSDetectorState(lg.State):
-    xs: Deque[float] = None
+    integrator: MovingIntegral = None
     samples_since_qrs: int = 0
     qrs_peak_value: float = .0
     noise_peak_value: float = .0
@@ -27,9 +25,15 @@ class QRSDetector(lg.Node):
     An ECG QRS Detector using the Pan-Tomkins algorithm. Based on
     Michał Sznajder and Marta Łukowska's implementation, which can
     be found at https://doi.org/10.5281/zenodo.583770
+
+    The filtering stages are computed incrementally (see MovingIntegral),
+    and peaks are only searched for when one tall enough to count could be
+    in the detection window, so most samples cost O(1). The output is the
+    same as running the algorithm over the whole buffer every sample.
     '''
 
     INPUT = lg.Topic(FloatMessage)
+    LEAD_INPUT = lg.Topic(LeadMessage)
     OUTPUT = lg.Topic(FloatMessage)
 
     state: QRSDetectorState
@@ -65,7 +69,16 @@ class QRSDetector(lg.Node):
         return self.state.samples_since_qrs / self.config.sfreq
 
     def setup(self) -> None:
-        self.state.xs = deque([0], self.buffer_size)
+        self.state.integrator = MovingIntegral(
+            self.buffer_size,
+            self.integration_win,
+            self.detection_window
+            )
+
+    def _reset_thresholds(self) -> None:
+        self.state.qrs_peak_value = .0
+        self.state.noise_peak_value = .0
+        self.state.threshold_value = .0
 
     def reset(self) -> None:
         '''
@@ -75,9 +88,17 @@ class QRSDetector(lg.Node):
         but keep current sample buffer.
         '''
         self.state.samples_since_qrs = 0
-        self.state.qrs_peak_value = .0
-        self.state.noise_peak_value = .0
-        self.state.threshold_value = .0
+        self._reset_thresholds()
+
+    def relearn(self) -> None:
+        '''
+        When the filter switches to another lead, the peak heights learned
+        from the old one no longer apply, so the buffer is emptied and the
+        thresholds are learned again from the new lead, as at startup. The
+        time since the last R-peak carries on.
+        '''
+        self.setup()
+        self._reset_thresholds()
 
     def detect_qrs(self):
         '''
@@ -92,12 +113,12 @@ class QRSDetector(lg.Node):
 
         ## peak detection:
 
-        # Derivative - provides QRS slope information.
-        ecg_deriv = np.ediff1d(self.state.xs)
-        # Squaring - intensifies values received in derivative.
-        ecg_deriv_sqr = ecg_deriv ** 2
-        # Moving-window integration.
-        integ_ecg = np.convolve(ecg_deriv_sqr, np.ones(self.integration_win))
+        # no peak in the detection window could clear the height limit
+        if not self.state.integrator.could_exceed(self.config.findpeaks_limit):
+            return
+        # Derivative, squaring and moving-window integration, kept up to
+        # date by the integrator as samples arrive.
+        integ_ecg = self.state.integrator.integrate()
         peak_idxs, _ = find_peaks(
             x = integ_ecg,
             height = self.config.findpeaks_limit,
@@ -142,8 +163,16 @@ class QRSDetector(lg.Node):
         Receives a new observation of filtered ECG time series, and yields the
         time since the last detected R-peak.
         '''
+        trace = ingress(message.trace, DETECTOR)
         x = message.data
         t = message.timestamp
-        self.state.xs.append(x)
+        self.state.integrator.append(x)
         self.detect_qrs() # updates self.t_since_qrs
-        yield self.OUTPUT, FloatMessage(timestamp = t, data = self.t_since_qrs)
+        yield self.OUTPUT, FloatMessage(
+            timestamp = t, data = self.t_since_qrs,
+            trace = egress(trace, DETECTOR)
+            )
+
+    @lg.subscriber(LEAD_INPUT)
+    async def switch_lead(self, message: LeadMessage) -> None:
+        self.relearn()
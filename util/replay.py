@@ -0,0 +1,88 @@
+import asyncio
+import h5py
+
+from ._messages import SampleMessage, SampleChunkMessage
+from ._rate import Rate
+from ._trace import new_trace, ingress, egress, SOURCE
+from .logs import column, iter_records
+import labgraph as lg
+
+class ReplayState(lg.State):
+    idx: int = 0 # records published so far
+
+class ReplayConfig(lg.Config):
+    path: str # .h5 log written by graph.py
+    topic: str = 'ecg_raw'
+    sfreq: float = 100. # rate the topic was logged at
+    speed: float = 1. # multiple of real time, or 0 for as fast as possible
+    # publish blocks of `chunk_size` samples on CHUNK_OUTPUT instead of
+    # single samples on OUTPUT
+    chunk: bool = False
+    chunk_size: int = 10
+    read_size: int = 10000 # records read from the file at a time
+
+class LogReplay(lg.Node):
+    '''
+    Plays a logged recording back through the graph in place of a live (or
+    simulated) ECG source. Samples keep the timestamps they were logged with,
+    so downstream topics can be compared against the original session.
+
+    The log is read from disk a block at a time, so sessions of any length
+    can be replayed. Raises NormalTermination once the log runs out.
+
+    Since the timestamps are old, latency traces of replayed samples are only
+    meaningful from the source's output onwards.
+    '''
+    OUTPUT = lg.Topic(SampleMessage)
+    CHUNK_OUTPUT = lg.Topic(SampleChunkMessage)
+
+    state: ReplayState
+    config: ReplayConfig
+
+    def setup(self) -> None:
+        self._file = h5py.File(self.config.path, 'r')
+        self._shutdown = False
+
+    def cleanup(self) -> None:
+        self._shutdown = True
+        self._file.close()
+
+    @lg.publisher(OUTPUT)
+    @lg.publisher(CHUNK_OUTPUT)
+    async def replay(self) -> lg.AsyncPublisher:
+        n = self.config.chunk_size if self.config.chunk else 1
+        speed = self.config.speed
+        if speed > 0: # make up missed ticks rather than drop samples
+            rate = Rate(self.config.sfreq * speed / n, policy = 'burst')
+        else:
+            rate = None
+        records = iter_records(
+            self._file[self.config.topic],
+            self.config.read_size,
+            start = self.state.idx
+            )
+        for block in records:
+            ts = column(block, 'timestamp').astype(float)
+            data = column(block, 'data').astype(float)
+            for i in range(0, ts.size, n):
+                if self._shutdown:
+                    return
+                trace = ingress(new_trace(), SOURCE)
+                if self.config.chunk:
+                    yield self.CHUNK_OUTPUT, SampleChunkMessage(
+                        timestamp = ts[i:i + n][-1],
+                        data = data[i:i + n],
+                        timestamps = ts[i:i + n],
+                        trace = egress(trace, SOURCE)
+                        )
+                else:
+                    yield self.OUTPUT, SampleMessage(
+                        timestamp = ts[i], data = data[i],
+                        trace = egress(trace, SOURCE)
+                        )
+                self.state.idx += ts[i:i + n].size
+                if rate is None:
+                    await asyncio.sleep(0) # let the rest of the loop run
+                else:
+                    await rate.sleep()
+        raise lg.NormalTermination()
@@ -1,14 +1,21 @@
 from psychopy import visual, event
+import psychopy
 import numpy as np
+import hashlib
+import json
+import os
 from psychopy.visual.filters import makeGrating
+import pyglet
+GL = pyglet.gl
 
-def make_gratings(win,
+def grating_texture(
     red_cycles = 10, red_phase = 0.,
     blue_cycles = 3, blue_phase = 0.,
-    grating_res = 256,
-    pos = (0, 0)
+    grating_res = 256
     ):
-
+    '''
+    Red and blue square-wave gratings at right angles, as an RGB texture.
+    '''
     red_grating = makeGrating(
         res = grating_res,
         ori = 45.,
@@ -26,10 +33,192 @@ def make_gratings(win,
     grating = np.ones((grating_res, grating_res, 3)) * -1.0 # black background
     grating[..., 0] = red_grating
     grating[..., -1] = blue_grating
+    return grating
+
+def _encode(x: np.ndarray, dtype) -> np.ndarray:
+    '''
+    Texture values (-1 or 1) in the storage dtype; uint8 maps them to 0, 255.
+    '''
+    if np.dtype(dtype) == np.uint8:
+        return ((x + 1.) * 127.5).astype(np.uint8)
+    return x.astype(dtype)
+
+def decode_texture(tex: np.ndarray) -> np.ndarray:
+    '''
+    A stored texture as the float32, -1 to 1 values psychopy wants.
+    '''
+    if tex.dtype == np.uint8:
+        return tex.astype(np.float32) / 127.5 - 1.
+    return np.asarray(tex, dtype = np.float32)
+
+def texture_dtype(n_textures: int, grating_res: int, max_mb: float):
+    '''
+    The most precise storage dtype (float32, else uint8) in which
+    `n_textures` textures fit in `max_mb` megabytes.
+    '''
+    for dtype in (np.float32, np.uint8):
+        n_bytes = n_textures * grating_res**2 * 3 * np.dtype(dtype).itemsize
+        if n_bytes <= max_mb * 2**20:
+            return dtype
+    raise ValueError(
+        '%d gratings at %dx%d need %.0f MB even as uint8, over the %.0f MB limit'
+        %(n_textures, grating_res, grating_res, n_bytes / 2**20, max_mb)
+    )
+
+def grating_textures(red_cycles, blue_cycles,
+    red_phase = 0., blue_phase = 0.,
+    grating_res = 256,
+    cache_dir = '.cache',
+    max_mb = 512.
+    ):
+    '''
+    Textures for every combination of `red_cycles` and `blue_cycles`, as a
+    read-only memory-mapped (n_red, n_blue, res, res, 3) array. It's float32
+    if that fits in `max_mb` megabytes, else uint8 (see `decode_texture`).
+
+    Each red and each blue grating is only rendered once; the combinations
+    are filled in by broadcasting them against each other, one row at a time
+    so no more than one row's worth is ever held in memory besides the
+    gratings themselves.
+
+    Making them is slow, so they're saved to `cache_dir` the first time and
+    loaded from there whenever the same set is asked for again. (Values are
+    all -1 or 1, so either dtype holds them exactly.)
+    '''
+    dtype = texture_dtype(len(red_cycles) * len(blue_cycles), grating_res, max_mb)
+    params = dict(
+        red_cycles = [float(c) for c in red_cycles],
+        blue_cycles = [float(c) for c in blue_cycles],
+        red_phase = red_phase,
+        blue_phase = blue_phase,
+        red_ori = 45.,
+        blue_ori = 3*45.,
+        grating_res = grating_res,
+        dtype = np.dtype(dtype).name,
+        psychopy = psychopy.__version__ # in case makeGrating ever changes
+    )
+    key = json.dumps(params, sort_keys = True).encode()
+    key = hashlib.sha1(key).hexdigest()[:16]
+    fpath = os.path.join(cache_dir, 'gratings_%s.npy'%key)
+    if not os.path.exists(fpath):
+        os.makedirs(cache_dir, exist_ok = True)
+        tmp_fpath = fpath.replace('.npy', '.tmp.npy')
+        reds = np.stack([
+            makeGrating(res = grating_res, ori = 45., cycles = c,
+                        phase = red_phase, gratType = 'sqr')
+            for c in red_cycles
+        ])
+        blues = np.stack([
+            makeGrating(res = grating_res, ori = 3*45., cycles = c,
+                        phase = blue_phase, gratType = 'sqr')
+            for c in blue_cycles
+        ])
+        reds, blues = _encode(reds, dtype), _encode(blues, dtype)
+        shape = (len(red_cycles), len(blue_cycles), grating_res, grating_res, 3)
+        texs = np.lib.format.open_memmap(
+            tmp_fpath, mode = 'w+', dtype = dtype, shape = shape
+            )
+        background = _encode(np.array(-1.), dtype) # black
+        for i in range(len(red_cycles)):
+            texs[i, ..., 0] = reds[i]
+            texs[i, ..., 1] = background
+            texs[i, ..., 2] = blues
+        texs.flush()
+        del texs
+        os.replace(tmp_fpath, fpath) # so a crash never leaves half a file
+    return np.load(fpath, mmap_mode = 'r')
+
+def make_gratings(win,
+    red_cycles = 10, red_phase = 0.,
+    blue_cycles = 3, blue_phase = 0.,
+    grating_res = 256,
+    pos = (0, 0),
+    tex = None
+    ):
+    '''
+    Makes a grating stim, from a pre-made (possibly uint8) texture `tex` if
+    there is one.
+
+    A uint8 texture is only decoded to float32 for as long as it takes to
+    upload it. psychopy keeps whatever array it was given as the stim's
+    `tex`, and only reads it again if the texture is set again (which the
+    display never does), so the stim is pointed back at `tex` itself, which
+    for a memory-mapped texture is just a view onto the cache file. Otherwise
+    every stim would hold a float32 copy, and storing the textures as uint8
+    to fit them in memory would be for nothing.
+    '''
+    stored = tex
+    if tex is None:
+        tex = grating_texture(
+            red_cycles, red_phase, blue_cycles, blue_phase, grating_res
+            )
+    else:
+        tex = decode_texture(tex)
     stim = visual.GratingStim(
         win = win,
-        tex = grating,
+        tex = tex,
         #mask = "circle",
         size = (grating_res, grating_res),
     )
+    if stored is not None and tex is not stored:
+        stim.__dict__['tex'] = stored # drop the decoded copy
     return stim
+
+class RivalryGratings(object):
+    """
+    The red and blue gratings as one stim per eye, whose spatial frequencies
+    can be set to any value on every frame instead of being picked from a
+    grid of pre-made textures.
+
+    Each grating is drawn with the color mask limited to its own channel, so
+    they combine the same way as the channels of a pre-made texture, over a
+    black square.
+    """
+    def __init__(self, win, grating_res = 256, pos = (0, 0)):
+        """
+        Constructor.
+        @param win: window to draw in (in 'pix' units)
+        @type  win: visual.Window
+        @param grating_res: width and height of the gratings, in pixels
+        @type  grating_res: int
+        @param pos: where to center them
+        @type  pos: tuple
+        """
+        self.grating_res = grating_res
+        self._background = visual.Rect(
+            win,
+            width = grating_res,
+            height = grating_res,
+            pos = pos,
+            fillColor = 'black',
+            lineColor = 'black'
+        )
+        self._red = visual.GratingStim(
+            win, tex = 'sqr', size = (grating_res, grating_res),
+            pos = pos, ori = 45.
+        )
+        self._blue = visual.GratingStim(
+            win, tex = 'sqr', size = (grating_res, grating_res),
+            pos = pos, ori = 3*45.
+        )
+
+    def set_cycles(self, red_cycles: float, blue_cycles: float) -> None:
+        """
+        @param red_cycles: cycles of the red grating across its width
+        @type  red_cycles: float
+        @param blue_cycles: cycles of the blue grating across its width
+        @type  blue_cycles: float
+        """
+        self._red.sf = red_cycles / self.grating_res # cycles per pixel
+        self._blue.sf = blue_cycles / self.grating_res
+
+    def draw(self) -> None:
+        """
+        Draws both gratings (for the next flip).
+        """
+        self._background.draw()
+        GL.glColorMask(True, False, False, True)
+        self._red.draw()
+        GL.glColorMask(False, False, True, True)
+        self._blue.draw()
+        GL.glColorMask(True, True, True, True)
@@ -1,4 +1,6 @@
 from psychopy.hardware.keyboard import Keyboard
+from psychopy import core
+from pylsl import local_clock
 from psychtoolbox import hid
 
 # fix psychtoolbox issue for older versions of psychopy
@@ -17,3 +19,27 @@ def get_keyboard(dev_name):
     'Cannot find %s! Available devices are %s.'%(dev_name, ', '.join(names))
         )
     return Keyboard(idx)
+
+def psychopy_to_lsl(n = 20):
+    '''
+    Offset to add to a psychopy clock time (`core.getTime()`, which is also
+    what keyboard events are timed with) to get the LSL local clock time,
+    from whichever of `n` paired readings were taken closest together.
+    '''
+    best = None
+    for i in range(n):
+        t0 = local_clock()
+        t = core.getTime()
+        t1 = local_clock()
+        if best is None or t1 - t0 < best[0]:
+            best = (t1 - t0, (t0 + t1) / 2 - t)
+    return best[1]
+
+def key_time(kb, key, offset):
+    '''
+    When `key` (from `kb.getKeys`) went down, on the LSL local clock.
+    `offset` is from `psychopy_to_lsl`.
+    '''
+    # tDown is already on the psychopy clock (it's `rt` that's relative to
+    # the keyboard clock's last reset)
+    return key.tDown + offset
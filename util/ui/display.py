@@ -1,13 +1,15 @@
 from dataclasses import field
+from collections import deque
 from itertools import product
 from typing import List, Tuple
 import numpy as np
 import asyncio
+import threading
 import time
 from pylsl import local_clock
 
 from psychopy import monitors, visual, core
-from ._gratings import make_gratings
+from ._gratings import make_gratings, grating_textures, RivalryGratings
 from ._instructions import (
     show_opening_instructions,
     show_break_instructions,
@@ -15,9 +17,15 @@ from ._instructions import (
     show_closing_instructions,
     get_2AFC
 )
-from ._input import get_keyboard
+from ._input import get_keyboard, psychopy_to_lsl, key_time
 
-from .._messages import DisplayMessage, ExperimentEventMessage
+from .._messages import (
+    DisplayMessage, ExperimentEventMessage, TraceMessage, MailboxStatsMessage,
+    FlipMessage
+)
+from .._mailbox import Mailbox
+from .._trace import ingress, egress, DISPLAY
+from ..control import stimulus_size
 import labgraph as lg
 
 class DisplayState(lg.State):
@@ -27,7 +35,6 @@ class DisplayState(lg.State):
     autoDraw_rivalry: bool = False
     autoDraw_disc: bool = False
     key_list: List[str] = field(default_factory = list)
-    ev_list: List[str] = field(default_factory = list)
 
 class DisplayConfig(lg.Config):
     # controls granularity of stimuli
@@ -36,24 +43,76 @@ class DisplayConfig(lg.Config):
     trials: int = 120
     trial_dur: float = 10.
     kb_name: str = 'Dell Dell USB Keyboard'
+    # longest we'll extrapolate cardiac phase past a sample's timestamp;
+    # beyond this (e.g. replayed logs) only the time since the size was
+    # computed is extrapolated over
+    max_extrapolation: float = .5
+    stats_interval: float = 1. # seconds between STATS_OUTPUT messages
+    # how often the keyboard thread checks for key presses; they're timed by
+    # the keyboard itself, so this only affects how soon they're published,
+    # and checking more often costs CPU on the machine drawing the stimuli
+    # (psychopy's waitKeys would be no better, as it checks in a busy loop)
+    key_interval: float = .05
+    flip_interval: float = .5 # seconds between FLIP_OUTPUT batches
+    cache_dir: str = '.cache' # where rendered grating textures are kept
+    # most memory the textures may take up; past float32's share of it they
+    # are stored as uint8
+    texture_mb: float = 512.
+    # set sizes straight from the control values, with one grating per eye and
+    # one circle per side, rather than picking from n_steps pre-made stims
+    continuous: bool = False
 
 class Display(lg.Node):
     """
     This node sets up psychopy stims, signals when it is ready and changes displayed
     stims according to events received on the specified topic.
+
+    The stims aren't changed when a message arrives, but just before each flip,
+    with the cardiac phase extrapolated to when that frame should go up, so
+    what's on screen matches the heart at the time it's seen.
     """
     DISPLAY_TOPIC = lg.Topic(DisplayMessage)
     EXPERIMENT_EVENTS = lg.Topic(ExperimentEventMessage)
+    TRACE_OUTPUT = lg.Topic(TraceMessage)
+    STATS_OUTPUT = lg.Topic(MailboxStatsMessage)
+    FLIP_OUTPUT = lg.Topic(FlipMessage)
 
     state: DisplayState
     config: DisplayConfig
 
     def setup(self) -> None:
         self._stims = None
+        self._gratings = None # RivalryGratings, in continuous mode
         self._shutdown = False
         self._fixation = None
+        self._traces = deque() # finished latency traces, to be published
+        # (flip time, interval, sizes, steps) of frames, to be published
+        self._flips = deque()
+        # only the newest (DisplayMessage, trace) is kept for the next flip
+        self._mailbox = Mailbox()
+        self._latest = None # the one on screen now
+        self._sizes = (0., 0.) # sizes currently shown
+        self._last_flip = None
+        self._frame_period = None
+        # (key, LSL time, sync_side) of events not yet published; appended to
+        # from any thread, and `_wakeup` is set to have them published
+        self._events = deque()
+        self._loop = None
+        self._wakeup = None
+        self._key_reader = None
         self.state.sync_side = np.random.choice(['left', 'right'])
         self.kb = get_keyboard(self.config.kb_name)
+        self._kb_offset = psychopy_to_lsl()
+        if self.config.continuous: # nothing to pre-make
+            return
+        # textures don't need the window, so they're rendered (or loaded from
+        # the cache) here rather than when the stims are made
+        steps = np.linspace(10, 5, self.config.n_steps)
+        self._textures = grating_textures(
+            steps, steps,
+            cache_dir = self.config.cache_dir,
+            max_mb = self.config.texture_mb
+        )
 
     def cleanup(self) -> None:
         """
@@ -62,6 +121,8 @@ class Display(lg.Node):
         loops.
         """
         self._shutdown = True
+        if self._key_reader is not None:
+            self._key_reader.join()
 
     def _setup_stims(self, win: visual.Window) -> np.ndarray:
         """
@@ -75,22 +136,28 @@ class Display(lg.Node):
             win, text = '+', color = "white", pos = (0, 0)
             )
         n_steps = self.config.n_steps
+        quarter_width = win.size[0]//4
+        left_pos = (0 - 2*quarter_width//3, 0)
+        right_pos = (0 + 2*quarter_width//3, 0)
+        self._radii = (quarter_width//8, quarter_width//4) # min, max
+
+        if self.config.continuous: # just one of each, resized every frame
+            self._gratings = RivalryGratings(win)
+            self._left_circle = visual.Circle(
+                win, pos = left_pos, fillColor = 'black'
+                )
+            self._right_circle = visual.Circle(
+                win, pos = right_pos, fillColor = 'black'
+                )
+            return
 
         # draw gratings for each step size
         self._stims = np.empty((n_steps, n_steps), dtype = object)
-        steps = np.linspace(10, 5, n_steps)
         for i, j in product(range(n_steps), range(n_steps)):
-            self._stims[i,j] = make_gratings(
-                win, red_cycles = steps[i], blue_cycles = steps[j]
-            )
+            self._stims[i,j] = make_gratings(win, tex = self._textures[i,j])
 
         # draw circles on each side of screen for each step size
-        quarter_width = win.size[0]//4
-        left_pos = (0 - 2*quarter_width//3, 0)
-        right_pos = (0 + 2*quarter_width//3, 0)
-        min_radius = quarter_width//8
-        max_radius = quarter_width//4
-        steps = np.linspace(min_radius, max_radius, n_steps)
+        steps = np.linspace(*self._radii, n_steps)
         self._left_circle = np.empty(n_steps, dtype = object)
         self._right_circle = np.empty(n_steps, dtype = object)
         for i, radius in enumerate(steps):
@@ -120,14 +187,47 @@ class Display(lg.Node):
     def update_stims(self, message: DisplayMessage) -> None:
         """
         This function subscribes to the specified topic that receives the "next"
-        stimulus state and updates the `autoDraw` status of pre-made stims.
+        stimulus state, and leaves it for the main thread to show at the next flip.
+        Anything that arrives before then is overwritten by the message after
+        it, so only the newest is ever acted on.
+        """
+        trace = ingress(message.trace, DISPLAY)
+        self._mailbox.put((message, trace), message.timestamp)
+
+    def _sizes_at(self, message: DisplayMessage, t: float) -> Tuple[float, float]:
         """
+        Sizes of the synchronous and asynchronous stimuli at time `t`, with
+        the cardiac phase from `message` extrapolated up to then.
+        """
+        if not np.isfinite(message.t_since): # no phase model to go on
+            return message.sz_sync, message.sz_async
+        elapsed = t - message.timestamp
+        if not 0. <= elapsed <= self.config.max_extrapolation:
+            elapsed = max(t - message.process_t, 0.)
+        t_since = message.t_since + elapsed
+        gain = -.5 / message.scale ** 2
+        sz_sync = stimulus_size(t_since, message.sync_lag, gain, message.ibi)
+        sz_async = stimulus_size(t_since, message.async_lag, gain, message.ibi)
+        return sz_sync, sz_async
+
+    def _show_steps(self, sz_sync: float, sz_async: float) -> None:
+        """
+        Updates the `autoDraw` status of pre-made stims to show the given sizes
+        (or, in continuous mode, sets the one stim per side to them).
+        """
+        self._sizes = (sz_sync, sz_async)
         if self.state.sync_side == 'left': # red is on the left eye
-            left_step = self._val_to_steps(message.sz_sync)
-            right_step = self._val_to_steps(message.sz_async)
+            left, right = sz_sync, sz_async
         else:
-            left_step = self._val_to_steps(message.sz_async)
-            right_step = self._val_to_steps(message.sz_sync)
+            left, right = sz_async, sz_sync
+        left_step = self._val_to_steps(left)
+        right_step = self._val_to_steps(right)
+        if self.config.continuous:
+            # steps are just kept for the record here
+            self.state.left_step = left_step
+            self.state.right_step = right_step
+            self._show_continuous(left, right)
+            return
         try: # turn off autodraw for old stim
             self._stims[self.state.left_step, self.state.right_step].autoDraw = False
             self._fixation.autoDraw = False
@@ -151,52 +251,192 @@ class Display(lg.Node):
         except: # this is just for right at startup when some of these
             None # state vars don't exist yet
 
+    def _show_continuous(self, left: float, right: float) -> None:
+        """
+        Sets the gratings' spatial frequencies and the circles' radii directly
+        from the sizes for each side, over the same ranges as the steps.
+        """
+        if self._gratings is None: # _setup_stims hasn't run yet
+            return
+        left, right = np.clip((left, right), 0., 1.)
+        self._gratings.set_cycles(10. - 5. * left, 10. - 5. * right)
+        min_radius, max_radius = self._radii
+        self._left_circle.radius = min_radius + left * (max_radius - min_radius)
+        self._right_circle.radius = min_radius + right * (max_radius - min_radius)
+        # the gratings are drawn by `_flip`, since they aren't a single stim
+        self._fixation.autoDraw = self.state.autoDraw_rivalry
+        self._left_circle.autoDraw = self.state.autoDraw_disc
+        self._right_circle.autoDraw = self.state.autoDraw_disc
 
-    @lg.publisher(EXPERIMENT_EVENTS)
-    async def event_listener(self):
+    def _redraw(self) -> None:
+        """
+        Applies a change to the task's `autoDraw` flags right away, instead of
+        waiting for the next `_flip` (e.g. before showing a prompt).
+        """
+        self._show_steps(*self._sizes)
+
+    def _flip(self, win: visual.Window) -> None:
+        """
+        Flips the window, first choosing the stimulus steps for the cardiac
+        phase expected when the frame goes up (one frame period after the
+        last flip), rather than whenever the latest message came in.
+        """
+        if self._frame_period is None:
+            self._frame_period = win.monitorFramePeriod or 1. / 60.
+        fresh = self._mailbox.take()
+        if fresh is not None:
+            self._latest = fresh
+        latest = self._latest
+        if latest is not None:
+            if self._last_flip is None:
+                t_flip = local_clock() + self._frame_period
+            else:
+                t_flip = max(self._last_flip + self._frame_period, local_clock())
+            self._show_steps(*self._sizes_at(latest[0], t_flip))
+        if self._gratings is not None and self.state.autoDraw_rivalry:
+            self._gratings.draw()
+            # anything drawn by hand before this (like the rivalry block's
+            # fixation, until its autoDraw is on) is now under the gratings
+            if not self._fixation.autoDraw:
+                self._fixation.draw()
+        win.flip()
+        now = local_clock()
+        period = np.nan
+        if self._last_flip is not None: # track the actual refresh rate
+            period = now - self._last_flip
+            if period < 1.5 * self._frame_period: # skip dropped frames
+                self._frame_period += .05 * (period - self._frame_period)
+        self._last_flip = now
+        self._flips.append((
+            now, period, self._sizes,
+            (self.state.left_step, self.state.right_step)
+            ))
+        if fresh is not None: # first frame showing this message
+            message, trace = fresh
+            self._traces.append(TraceMessage(
+                timestamp = message.timestamp, trace = egress(trace, DISPLAY)
+                ))
+
+    @lg.publisher(TRACE_OUTPUT)
+    async def publish_traces(self) -> lg.AsyncPublisher:
+        """
+        Publishes the latency traces of samples once the stimuli they set
+        have been flipped onto the screen, for the LatencyMonitor and the
+        logs. Samples superseded before the next flip never get there.
+        """
         while not self._shutdown:
+            while self._traces:
+                yield self.TRACE_OUTPUT, self._traces.popleft()
+            await asyncio.sleep(.05)
 
-            ## handle start and finish events
-            if self.state.ev_list:
-                ev_name = self.state.ev_list.pop(0)
-                yield self.EXPERIMENT_EVENTS, ExperimentEventMessage(
-                                            timestamp = local_clock(),
-                                            key = ev_name,
-                                            key_t = float(core.getAbsTime()),
-                                            sync_side = self.state.sync_side
-                                            )
-            # handle user input events
+    @lg.publisher(FLIP_OUTPUT)
+    async def publish_flips(self) -> lg.AsyncPublisher:
+        """
+        Publishes the timing and content of the frames flipped since the last
+        batch, so dropped frames can be lined up with the ECG afterwards.
+        The main thread only ever appends to a deque, so it never waits on this.
+        """
+        while not self._shutdown:
+            await asyncio.sleep(self.config.flip_interval)
+            n = len(self._flips)
+            if not n:
+                continue
+            flips = [self._flips.popleft() for i in range(n)]
+            flip_t, interval, sizes, steps = zip(*flips)
+            sizes = np.array(sizes, dtype = float)
+            steps = np.array(steps, dtype = float)
+            yield self.FLIP_OUTPUT, FlipMessage(
+                timestamp = flip_t[-1],
+                flip_t = np.array(flip_t, dtype = float),
+                interval = np.array(interval, dtype = float),
+                sz_sync = sizes[:, 0].copy(),
+                sz_async = sizes[:, 1].copy(),
+                step_left = steps[:, 0].copy(),
+                step_right = steps[:, 1].copy()
+                )
+
+    @lg.publisher(STATS_OUTPUT)
+    async def publish_stats(self) -> lg.AsyncPublisher:
+        """
+        Reports how many stimulus updates were coalesced or dropped, i.e. how
+        often the display has fallen behind its input.
+        """
+        while not self._shutdown:
+            await asyncio.sleep(self.config.stats_interval)
+            yield self.STATS_OUTPUT, MailboxStatsMessage(
+                timestamp = local_clock(), **self._mailbox.stats()
+                )
+
+    def _post_event(self, key: str, t: float = None) -> None:
+        """
+        Queues an experiment event to be published right away, timed on the
+        LSL clock (at the call, by default) along with the current sync side.
+        Can be called from any thread.
+        """
+        if t is None:
+            t = local_clock()
+        self._events.append((key, t, self.state.sync_side))
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _read_keys(self) -> None:
+        """
+        Passes on key presses as they come in, timed by when the key went down
+        rather than when it was seen, while there are keys to listen for.
+        """
+        while not self._shutdown:
             if self.state.key_list:
-                key_pressed = self.kb.getKeys(
+                keys = self.kb.getKeys(
                     keyList = self.state.key_list,
                     waitRelease = False,
-                    clear  = True
+                    clear = True
                     )
-            else:
-                key_pressed = []
-            if key_pressed:
+                for key in keys:
+                    t = key_time(self.kb, key, self._kb_offset)
+                    self._post_event(key.name, t)
+            time.sleep(self.config.key_interval)
+
+    @lg.publisher(EXPERIMENT_EVENTS)
+    async def event_listener(self):
+        """
+        Publishes experiment events (task start/end markers, responses and key
+        presses) as soon as they're posted, with `timestamp` and `key_t` both
+        the time they happened on the LSL clock.
+        """
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_event_loop()
+        self._key_reader = threading.Thread(target = self._read_keys, daemon = True)
+        self._key_reader.start()
+        while not self._shutdown:
+            self._wakeup.clear()
+            while self._events:
+                key, t, sync_side = self._events.popleft()
                 yield self.EXPERIMENT_EVENTS, ExperimentEventMessage(
-                                            timestamp = local_clock(),
-                                            key = key_pressed[0].name,
-                                            key_t = key_pressed[0].tDown,
-                                            sync_side = self.state.sync_side
+                                            timestamp = t,
+                                            key = key,
+                                            key_t = t,
+                                            sync_side = sync_side
                                             )
-            await asyncio.sleep(.05)
+            try: # until the next event, checking now and then for shutdown
+                await asyncio.wait_for(self._wakeup.wait(), timeout = .5)
+            except asyncio.TimeoutError:
+                pass
 
     def rivalry_block(self, win, duration):
         timeout = False
         clock = core.Clock()
         self.state.key_list = ['left', 'right'] # start listening for keys
-        self.state.ev_list.append('start_rivalry') # mark event time
+        self._post_event('start_rivalry') # mark event time
         self.state.autoDraw_rivalry = True
         clock.reset(0.)
         while not timeout:
             self._fixation.draw()
-            win.flip()
+            self._flip(win)
             timeout = clock.getTime() > duration
-        self.state.key_list = [] # stop listening for keys in event loop
-        self.state.ev_list.append('end_rivalry')
+        self.state.key_list = [] # stop listening for keys in key thread
+        self._post_event('end_rivalry')
         self.state.autoDraw_rivalry = False
+        self._redraw()
         core.wait(.05)
 
     @lg.main
@@ -240,19 +480,20 @@ class Display(lg.Node):
         clock = core.Clock()
         for trial in range(1, self.config.trials + 1):
             self._fixation.draw()
-            win.flip()
+            self._flip(win)
             core.wait(1.)
             self.state.autoDraw_disc = True
             self.state.sync_side = np.random.choice(['left', 'right'])
-            self.state.ev_list.append('start_trial%d'%trial)
+            self._post_event('start_trial%d'%trial)
             clock.reset()
             while not (clock.getTime() > self.config.trial_dur):
-                win.flip()
-            self.state.ev_list.append('end_trial%d'%trial)
+                self._flip(win)
+            self._post_event('end_trial%d'%trial)
             self.state.autoDraw_disc = False
+            self._redraw()
             core.wait(.05)
             resp = get_2AFC(win, self.kb) # ask which side was syncronous
-            self.state.ev_list.append('resp_%s'%resp) # and record response
+            self._post_event('resp_%s'%resp) # and record response
 
         show_closing_instructions(win, self.kb)
         win.close()